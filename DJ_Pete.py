@@ -1,16 +1,38 @@
+import time
+
+# Startup timings are measured from here, before the heavy imports.
+BOOTED = time.perf_counter()
+
 import asyncio
+import audioop
+import bisect
+import collections
+import concurrent.futures
 import functools
+import importlib.util
 import itertools
 import random
 import math
+import multiprocessing
 import os
+import re
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
 import discord
-import youtube_dl
 from async_timeout import timeout
 from discord.ext import commands, tasks
 import json
 
-youtube_dl.utils.bug_reports_message = lambda: ''
+# Imported by Radio.load during warm-up; only autoplay needs it, and it takes a good while to load.
+numpy = None
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# Imported by YTDLSource.load_extractors once the bot is online; it's slower to load than the gateway is to connect.
+youtube_dl = None
 
 async def userCheck(ctx):
     if ctx.author.id == 468900330244145153:
@@ -24,9 +46,1091 @@ class VoiceError(Exception):
 class YTDLError(Exception):
     pass
 
+
+class ExtractionBusy(YTDLError):
+    pass
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timings = {}
+
+    def incr(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def observe(self, name: str, value: float):
+        count, total, peak = self.timings.get(name, (0, 0.0, 0.0))
+        self.timings[name] = (count + 1, total + value, max(peak, value))
+
+    def average(self, name: str):
+        count, total, _ = self.timings.get(name, (0, 0.0, 0.0))
+        return total / count if count else 0.0
+
+    def report(self):
+        lines = ['{}: {}'.format(name, value) for name, value in sorted(self.counters.items())]
+        for name, (count, total, peak) in sorted(self.timings.items()):
+            lines.append('{}: avg {:.2f} ms, max {:.2f} ms ({} samples)'.format(name, total / count * 1000, peak * 1000, count))
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+class MetadataCache:
+    # googlevideo stream URLs carry their own expiry, usually ~6 hours out.
+    DEFAULT_TTL = 5 * 60 * 60
+    EXPIRY_MARGIN = 10 * 60
+    NEGATIVE_TTL = 60
+    DROPPED_KEYS = ('formats', 'requested_formats', 'thumbnails', 'subtitles', 'automatic_captions')
+    FORMAT_KEYS = ('format_id', 'url', 'ext', 'acodec', 'vcodec', 'abr', 'tbr', 'filesize')
+
+    def __init__(self, path: str = 'metadata_cache.db', size: int = 512):
+        self.size = size
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Shard clusters share this file; WAL lets them read while one of them writes.
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, expires REAL, error TEXT, data TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS metadata_expires ON metadata (expires)')
+        self._db.commit()
+
+    @staticmethod
+    def normalize(search: str):
+        search = ' '.join(search.split())
+        if re.match(r'^https?://', search):
+            return 'u:' + search
+        return 'q:' + search.lower()
+
+    @classmethod
+    def expiry(cls, info: dict):
+        match = re.search(r'[?&/]expire[=/](\d+)', info.get('url') or '')
+        if match:
+            return int(match.group(1)) - cls.EXPIRY_MARGIN
+        return time.time() + cls.DEFAULT_TTL
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str):
+        with self._lock:
+            row = self._db.execute('SELECT expires, error, data FROM metadata WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        expires, error, data = row
+        return expires, error, json.loads(data) if data else None
+
+    def _store(self, key: str, entry: tuple):
+        expires, error, data = entry
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                             (key, expires, error, json.dumps(data) if data is not None else None))
+            self._db.commit()
+
+    def sweep(self):
+        # Expired rows are already ignored on read; this just keeps the file from growing. Runs from the reaper.
+        with self._lock:
+            swept = self._db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),)).rowcount
+            self._db.commit()
+        metrics.incr('cache.swept', swept)
+
+    async def get(self, key: str, loop: asyncio.BaseEventLoop):
+        tier = 'memory'
+        entry = self._memory.get(key)
+        if entry is None:
+            tier = 'disk'
+            entry = await loop.run_in_executor(None, self._load, key)
+
+        if entry is None or entry[0] < time.time():
+            self._memory.pop(key, None)
+            metrics.incr('cache.misses')
+            return None
+
+        self._remember(key, entry)
+        metrics.incr('cache.{}_hits'.format(tier))
+        expires, error, data = entry
+        if error is not None:
+            metrics.incr('cache.negative_hits')
+            raise YTDLError(error)
+        return data
+
+    async def put(self, keys, info: dict, loop: asyncio.BaseEventLoop):
+        data = {k: v for k, v in info.items() if k not in self.DROPPED_KEYS}
+        if info.get('formats'):
+            # Only the audio-bearing formats are worth keeping, and only what format selection looks at.
+            data['formats'] = [{k: f.get(k) for k in self.FORMAT_KEYS}
+                               for f in info['formats'] if f.get('acodec') != 'none']
+        entry = (self.expiry(info), None, data)
+        for key in keys:
+            self._remember(key, entry)
+            await loop.run_in_executor(None, self._store, key, entry)
+
+    async def put_error(self, key: str, error: str, loop: asyncio.BaseEventLoop):
+        entry = (time.time() + self.NEGATIVE_TTL, error, None)
+        self._remember(key, entry)
+        await loop.run_in_executor(None, self._store, key, entry)
+
+
+class SharedCounters(dict):
+    # Local view of values every shard cluster adds to. Our own changes pile up as deltas until take().
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created = {}
+        self.deltas = {}
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.deltas[key] = self.deltas.get(key, 0) + value - self[key]
+        else:
+            self.created[key] = value
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        # dict.setdefault skips __setitem__, and a default nobody records would never reach the store.
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    @property
+    def dirty(self):
+        return bool(self.created or self.deltas)
+
+    def take(self):
+        taken = list(self.created.items()), [(key, delta) for key, delta in self.deltas.items() if delta]
+        self.created, self.deltas = {}, {}
+        return taken
+
+    def restore(self, taken):
+        created, deltas = taken
+        for key, value in created:
+            self.created.setdefault(key, value)
+        for key, delta in deltas:
+            self.deltas[key] = self.deltas.get(key, 0) + delta
+
+    def merge(self, rows):
+        # Totals from the store, plus whatever we've changed since and not written yet.
+        for key, value in rows:
+            super().__setitem__(key, value + self.deltas.get(key, 0))
+
+
+class StateStore:
+    # Every row carries the sequence number of the write that last touched it, so a process
+    # only has to read what changed since the last sequence it saw.
+    COUNTERS = (('users', 'id', 'opinion'), ('counters', 'name', 'value'))
+
+    def __init__(self, path: str = 'pete_state.db'):
+        self._lock = threading.Lock()
+        # One writer thread keeps saves ordered without blocking the event loop.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='state')
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, opinion REAL, seq INTEGER DEFAULT 0)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL, seq INTEGER DEFAULT 0)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS queues (guild_id INTEGER PRIMARY KEY, data TEXT, position REAL)')
+        if 'position' not in [row[1] for row in self._db.execute('PRAGMA table_info(queues)')]:
+            self._db.execute('ALTER TABLE queues ADD COLUMN position REAL')
+        if 'seq' not in [row[1] for row in self._db.execute('PRAGMA table_info(users)')]:
+            self._db.execute('ALTER TABLE users ADD COLUMN seq INTEGER DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS users_seq ON users (seq)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS counters_seq ON counters (seq)')
+        self._db.execute("INSERT OR IGNORE INTO settings VALUES ('seq', 0)")
+        # Mood used to be a plain setting, back when only one process wrote it.
+        self._db.execute("INSERT OR IGNORE INTO counters SELECT 'mood', value, 0 FROM settings WHERE key = 'mood'")
+        self._db.commit()
+
+    def migrate(self, users_path: str = 'known_users.txt', mood_path: str = 'mood.txt'):
+        # One-off import of the old JSON files; json turned the user ids into strings.
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM counters WHERE name = 'mood'").fetchone():
+                return
+        if not (os.path.exists(users_path) and os.path.exists(mood_path)):
+            return
+        with open(users_path, 'r') as infile:
+            users = [(int(id), opinion) for id, opinion in json.load(infile).items()]
+        with open(mood_path, 'r') as infile:
+            mood = json.load(infile)
+        self.write((users, []), ([('mood', mood)], []))
+        print('Migrated {} known users from {}'.format(len(users), users_path))
+
+    def load(self):
+        users, counters, seq = self.changes(-1)
+        return SharedCounters(users), SharedCounters(counters), seq
+
+    def write(self, users, counters):
+        # users and counters are SharedCounters.take() results: rows first seen here, and deltas to add.
+        with self._lock, self._db:
+            self._db.execute("UPDATE settings SET value = value + 1 WHERE key = 'seq'")
+            seq = int(self._db.execute("SELECT value FROM settings WHERE key = 'seq'").fetchone()[0])
+            for (table, key, column), (created, deltas) in zip(self.COUNTERS, (users, counters)):
+                # Somebody else may have seen the row first; theirs wins and our deltas land on top.
+                self._db.executemany('INSERT OR IGNORE INTO {} VALUES (?, ?, ?)'.format(table),
+                                     [(name, value, seq) for name, value in created])
+                self._db.executemany('INSERT INTO {0} VALUES (?, ?, ?) ON CONFLICT ({1}) DO UPDATE SET '
+                                     '{2} = {2} + excluded.{2}, seq = excluded.seq'.format(table, key, column),
+                                     [(name, delta, seq) for name, delta in deltas])
+
+    def changes(self, since: int):
+        # Both tables have to come from one snapshot, or a write landing in between gets skipped.
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                users = self._db.execute('SELECT id, opinion, seq FROM users WHERE seq > ?', (since,)).fetchall()
+                counters = self._db.execute('SELECT name, value, seq FROM counters WHERE seq > ?', (since,)).fetchall()
+            finally:
+                self._db.commit()
+        seq = max([row[2] for row in users + counters], default=since)
+        return [row[:2] for row in users], [row[:2] for row in counters], seq
+
+    def sync(self, users, counters, since: int):
+        if users[0] or users[1] or counters[0] or counters[1]:
+            self.write(users, counters)
+        return self.changes(since)
+
+    async def save(self, users, counters, since: int, loop: asyncio.BaseEventLoop):
+        return await loop.run_in_executor(self._executor, self.sync, users, counters, since)
+
+    def load_queues(self):
+        with self._lock:
+            rows = self._db.execute('SELECT guild_id, data, position FROM queues').fetchall()
+        snapshots = {}
+        for guild_id, data, position in rows:
+            snapshots[guild_id] = snapshot = json.loads(data)
+            # Older rows kept the position inside the JSON.
+            if position is not None or 'position' not in snapshot:
+                snapshot['position'] = position
+        return snapshots
+
+    def write_queues(self, snapshots: dict, positions: dict, dropped):
+        # snapshots map to (songs JSON, position); a queue that only moved further into its song just gets positions.
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO queues VALUES (?, ?, ?)',
+                                 [(guild_id, data, position) for guild_id, (data, position) in snapshots.items()])
+            self._db.executemany('UPDATE queues SET position = ? WHERE guild_id = ?',
+                                 [(position, guild_id) for guild_id, position in positions.items()])
+            self._db.executemany('DELETE FROM queues WHERE guild_id = ?', [(guild_id,) for guild_id in dropped])
+
+    async def save_queues(self, snapshots: dict, positions: dict, dropped, loop: asyncio.BaseEventLoop):
+        await loop.run_in_executor(self._executor, self.write_queues, snapshots, positions, dropped)
+
+
+Format = collections.namedtuple('Format', 'format_id url acodec vcodec bitrate')
+
+
+class Track:
+    __slots__ = ('id', 'title', 'uploader', 'uploader_url', 'upload_date', 'duration', 'thumbnail', 'url',
+                 'stream_url', 'acodec', 'bitrate', 'expires', 'formats', 'tags')
+    TAGS = 10
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_info(cls, info: dict):
+        # Flat search and playlist entries are unresolved: their 'url' is a page or an id, not a stream.
+        resolved = info.get('_type', 'video') == 'video' and 'url' in info
+        formats = tuple(Format(f.get('format_id'), f['url'], f.get('acodec'), f.get('vcodec'),
+                               f.get('abr') or f.get('tbr') or 0)
+                        for f in info.get('formats') or () if f.get('acodec') != 'none' and f.get('url'))
+        return cls(id=info.get('id'), title=info.get('title'), uploader=info.get('uploader'),
+                   uploader_url=info.get('uploader_url'), upload_date=info.get('upload_date'),
+                   duration=int(info['duration']) if info.get('duration') else None,
+                   thumbnail=info.get('thumbnail'), url=info.get('webpage_url'),
+                   stream_url=info['url'] if resolved else None, acodec=info.get('acodec'),
+                   bitrate=info.get('abr') or info.get('tbr'),
+                   expires=MetadataCache.expiry(info) if resolved else None, formats=formats or None,
+                   tags=tuple(info.get('tags') or ())[:cls.TAGS] or None)
+
+    def to_info(self):
+        return {'id': self.id, 'title': self.title, 'uploader': self.uploader, 'uploader_url': self.uploader_url,
+                'upload_date': self.upload_date, 'duration': self.duration, 'thumbnail': self.thumbnail,
+                'webpage_url': self.url, 'acodec': self.acodec, 'tags': list(self.tags or ())}
+
+    def select(self, cap: int = None):
+        if self.formats:
+            best = YTDLSource.select_format(self.formats, cap)
+            self.stream_url, self.acodec, self.bitrate = best.url, best.acodec, best.bitrate
+            self.formats = None
+        return self
+
+
+class TrackIndex:
+    # Words we've never seen are matched to known ones sharing this much of their trigrams (Dice).
+    SIMILARITY = 0.6
+    # More tracks than this containing every word means the query is too vague to answer locally.
+    AMBIGUITY = 8
+    MIN_LETTERS = 4
+    # The query has to name at least this much of the title's meaningful words to be answered without YouTube.
+    COVERAGE = 0.5
+    # Words half of YouTube puts in its titles; they neither find a track nor count towards covering one.
+    GENERIC = frozenset(('official', 'video', 'music', 'audio', 'lyrics', 'lyric', 'hd', 'hq', 'mv', 'vevo', 'topic',
+                         'remastered', 'remaster', 'version', 'full', 'song', 'ft', 'feat', 'the', 'a', 'an', 'of',
+                         'and', 'by'))
+
+    def __init__(self, path: str = 'metadata_cache.db'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS tracks (id TEXT PRIMARY KEY, url TEXT, title TEXT, uploader TEXT, '
+                         'duration INTEGER, tags TEXT)')
+        self._db.commit()
+
+        self._tracks = []
+        self._lengths = []
+        self._ids = {}
+        self._postings = {}
+        self._vocabulary = {}
+        self._grams = collections.defaultdict(list)
+        self.loaded = False
+        self._early = []
+
+    def load(self):
+        # Runs on a worker thread after login. Until finish(), lookups miss and new tracks wait in _early.
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM tracks').fetchall()
+        for id, url, title, uploader, duration, tags in rows:
+            self._insert((id, url, title, uploader, duration), json.loads(tags) if tags else ())
+
+    def finish(self):
+        for row, tags in self._early:
+            if row[0] not in self._ids:
+                self._insert(row, tags)
+        self._early = None
+        self.loaded = True
+
+    def __len__(self):
+        return len(self._tracks)
+
+    @staticmethod
+    def words(text: str):
+        return re.findall(r'\w+', text.lower())
+
+    @staticmethod
+    def trigrams(word: str):
+        word = ' {} '.format(word)
+        return frozenset(word[i:i + 3] for i in range(len(word) - 2))
+
+    def _insert(self, row: tuple, tags):
+        id, url, title, uploader, duration = row
+        number = len(self._tracks)
+        self._tracks.append(row)
+        self._lengths.append(len(set(self.words(title)) - self.GENERIC))
+        self._ids[id] = number
+        # Tags stay out: "rock" or "pop" says nothing about which song somebody means.
+        for word in set(self.words(' '.join([title, uploader or '']))) - self.GENERIC:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                grams = self._vocabulary[word] = self.trigrams(word)
+                for gram in grams:
+                    self._grams[gram].append(word)
+            postings.add(number)
+
+    def _store(self, row: tuple, tags):
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO tracks VALUES (?, ?, ?, ?, ?, ?)', row + (json.dumps(tags),))
+            self._db.commit()
+
+    def add(self, track: Track, loop: asyncio.BaseEventLoop):
+        if not track.id or not track.title or not track.url or track.id in self._ids:
+            return
+        row = (track.id, track.url, track.title, track.uploader, track.duration)
+        tags = list(track.tags or ())
+        if self.loaded:
+            self._insert(row, tags)
+        else:
+            self._early.append((row, tags))
+        loop.run_in_executor(None, self._store, row, tags)
+
+    def correct(self, word: str):
+        wanted = self.trigrams(word)
+        # A similar enough word shares at least S / (2 - S) of our trigrams, so it has to show up in the posting
+        # lists of the rarest `slack + 1` of them; only those get walked.
+        slack = int(len(wanted) * (1 - self.SIMILARITY / (2 - self.SIMILARITY)))
+        rarest = sorted(wanted, key=lambda gram: len(self._grams.get(gram, ())))[:slack + 1]
+        best, best_score = None, self.SIMILARITY
+        for gram in rarest:
+            for candidate in self._grams.get(gram, ()):
+                grams = self._vocabulary[candidate]
+                score = 2 * len(wanted & grams) / (len(wanted) + len(grams))
+                if score >= best_score:
+                    best, best_score = candidate, score
+        return best
+
+    def lookup(self, query: str):
+        words = set(self.words(query)) - self.GENERIC
+        if not self.loaded or sum(map(len, words)) < self.MIN_LETTERS:
+            return None
+
+        postings, found, exact = [], set(), 0
+        for word in words:
+            if word in self._postings:
+                exact += len(word)
+            elif len(word) >= self.MIN_LETTERS and len(words) > 1:
+                word = self.correct(word)
+            if word not in self._postings:
+                return None
+            found.add(word)
+            postings.append(self._postings[word])
+        # Corrected words only narrow things down; something spelt right has to say which song it is
+        # ("believe" alone would turn into "believer").
+        if exact < self.MIN_LETTERS:
+            return None
+
+        postings.sort(key=len)
+        matches = postings[0].intersection(*postings[1:])
+        if not matches or len(matches) > self.AMBIGUITY:
+            return None
+
+        def coverage(number: int):
+            title = set(self.words(self._tracks[number][2])) - self.GENERIC
+            return len(title & found) / len(title) if title else 0.0
+
+        # Of the tracks containing every word, the one whose title has the fewest extra words is the closest.
+        number = min(matches, key=lambda number: (self._lengths[number], number))
+        return number if coverage(number) >= self.COVERAGE else None
+
+    def match(self, query: str):
+        start = time.perf_counter()
+        number = self.lookup(query)
+        metrics.observe('index.lookup', time.perf_counter() - start)
+        if number is None:
+            metrics.incr('index.misses')
+            return None
+        metrics.incr('index.hits')
+        id, url, title, uploader, duration = self._tracks[number]
+        return {'_type': 'url', 'id': id, 'webpage_url': url, 'title': title, 'uploader': uploader,
+                'duration': duration}
+
+
+class Radio:
+    # Hashed feature vectors: every tag, the uploader, title words and whoever requested the track.
+    DIMENSIONS = 256
+    SESSION = 10
+    HISTORY = 50
+    CHOICES = 5
+    WEIGHTS = {'tag': 1.0, 'up': 1.0, 'req': 0.5, 'word': 0.5}
+
+    def __init__(self, index: TrackIndex, path: str = 'metadata_cache.db'):
+        self.index = index
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS plays (guild_id INTEGER, id TEXT, requester INTEGER, played REAL)')
+        self._db.commit()
+        self._sessions = collections.defaultdict(lambda: collections.deque(maxlen=self.HISTORY))
+
+        self._tracks = []
+        self._features = []
+        self._rows = {}
+        self._matrix = None
+        self.loaded = False
+        self._early = []
+
+    def load(self):
+        # Runs on a worker thread after login, like TrackIndex.load.
+        global numpy
+        if not HAS_NUMPY:
+            return
+        start = time.perf_counter()
+        import numpy
+        metrics.observe('startup.numpy_import', time.perf_counter() - start)
+        self._matrix = numpy.zeros((64, self.DIMENSIONS), dtype=numpy.float32)
+        with self._lock:
+            rows = self._db.execute('SELECT t.id, t.url, t.title, t.uploader, t.duration, t.tags, '
+                                    'group_concat(DISTINCT p.requester) FROM plays p JOIN tracks t ON t.id = p.id '
+                                    'GROUP BY t.id').fetchall()
+        for id, url, title, uploader, duration, tags, requesters in rows:
+            self._learn((id, url, title, uploader, duration), json.loads(tags) if tags else (), uploader,
+                        requesters.split(',') if requesters else ())
+
+    def finish(self):
+        for args in self._early if numpy is not None else ():
+            self._learn(*args)
+        self._early = None
+        self.loaded = True
+
+    @property
+    def available(self):
+        return HAS_NUMPY
+
+    def _features_of(self, title: str, uploader: str, tags):
+        features = {'tag:' + tag.lower() for tag in tags}
+        features.update('word:' + word for word in TrackIndex.words(title))
+        if uploader:
+            features.add('up:' + uploader.lower())
+        return features
+
+    def _vector(self, features):
+        vector = numpy.zeros(self.DIMENSIONS, dtype=numpy.float32)
+        for feature in features:
+            kind = feature.split(':', 1)[0]
+            vector[zlib.crc32(feature.encode()) % self.DIMENSIONS] += self.WEIGHTS[kind]
+        norm = numpy.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _learn(self, row: tuple, tags, uploader: str, requesters):
+        id = row[0]
+        number = self._rows.get(id)
+        if number is None:
+            number = self._rows[id] = len(self._tracks)
+            self._tracks.append(row)
+            self._features.append(self._features_of(row[2], uploader, tags))
+            if number == len(self._matrix):
+                self._matrix = numpy.concatenate([self._matrix, numpy.zeros_like(self._matrix)])
+        features = self._features[number]
+        features.update('req:{}'.format(requester) for requester in requesters)
+        self._matrix[number] = self._vector(features)
+
+    def _store(self, guild_id: int, id: str, requester: int):
+        with self._lock:
+            self._db.execute('INSERT INTO plays VALUES (?, ?, ?, ?)', (guild_id, id, requester, time.time()))
+            self._db.commit()
+
+    def record(self, guild_id: int, song: 'Song', loop: asyncio.BaseEventLoop):
+        track = song.track
+        if not track.id or not track.url:
+            return
+        # Pete's own picks shouldn't count as anyone's taste.
+        requester = None if song.requester.bot else song.requester.id
+        self.index.add(track, loop)
+        loop.run_in_executor(None, self._store, guild_id, track.id, requester)
+        self._sessions[guild_id].append(track.id)
+        if HAS_NUMPY:
+            args = ((track.id, track.url, track.title, track.uploader, track.duration), track.tags or (),
+                    track.uploader, [requester] if requester else ())
+            if self.loaded:
+                self._learn(*args)
+            else:
+                self._early.append(args)
+
+    def pick(self, guild_id: int):
+        session = self._sessions.get(guild_id)
+        if numpy is None or not self.loaded or not session or not self._tracks:
+            return None
+
+        start = time.perf_counter()
+        recent = [self._rows[id] for id in itertools.islice(reversed(session), self.SESSION) if id in self._rows]
+        profile = self._matrix[recent].sum(axis=0)
+        scores = self._matrix[:len(self._tracks)] @ profile
+        scores[[self._rows[id] for id in set(session) if id in self._rows]] = -numpy.inf
+        top = numpy.argpartition(scores, -self.CHOICES)[-self.CHOICES:] if len(scores) > self.CHOICES else numpy.arange(len(scores))
+        top = top[scores[top] > 0]
+        metrics.observe('radio.pick', time.perf_counter() - start)
+        if not len(top):
+            return None
+
+        number = int(random.choices(top, weights=scores[top])[0])
+        id, url, title, uploader, duration = self._tracks[number]
+        return {'_type': 'url', 'id': id, 'webpage_url': url, 'title': title, 'uploader': uploader,
+                'duration': duration}
+
+
+class AudioCache:
+    ENABLED = True
+    DIRECTORY = 'audio_cache'
+    BUDGET = 2 * 1024 ** 3
+    FILLS = 2
+    BITRATE = 96
+    # Seconds a fill may take beyond the track's own length before FFmpeg is killed.
+    TIMEOUT = 60
+
+    def __init__(self, directory: str = DIRECTORY, budget: int = BUDGET, fills: int = FILLS):
+        self.directory = directory
+        self.budget = budget
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=fills, thread_name_prefix='audio-cache')
+        self._filling = set()
+        self._files = collections.OrderedDict()
+        self.size = 0
+
+        if not self.ENABLED:
+            return
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.opus')]
+        for path in sorted(paths, key=os.path.getmtime):
+            video_id = os.path.basename(path)[:-len('.opus')]
+            if os.path.exists(self.path(video_id, '.json')):
+                self._files[video_id] = os.path.getsize(path)
+                self.size += self._files[video_id]
+
+    def path(self, video_id: str, extension: str = '.opus'):
+        return os.path.join(self.directory, re.sub(r'[^\w-]', '_', video_id) + extension)
+
+    async def lookup(self, video_id: str, loop: asyncio.BaseEventLoop):
+        if video_id not in self._files:
+            metrics.incr('audio_cache.misses')
+            return None
+
+        try:
+            track = await loop.run_in_executor(None, self._load, video_id)
+        except (OSError, ValueError):
+            self._forget(video_id)
+            metrics.incr('audio_cache.misses')
+            return None
+
+        self._files.move_to_end(video_id)
+        metrics.incr('audio_cache.hits')
+        metrics.incr('audio_cache.bytes_served', self._files[video_id])
+        return self.path(video_id), track
+
+    def _load(self, video_id: str):
+        # Touching the file keeps the LRU order across restarts.
+        os.utime(self.path(video_id))
+        with open(self.path(video_id, '.json'), 'r') as infile:
+            return Track.from_info(json.load(infile))
+
+    def fill(self, track: Track, loop: asyncio.BaseEventLoop):
+        video_id = track.id
+        if not self.ENABLED or not video_id or video_id in self._files or video_id in self._filling:
+            return
+        # Livestreams never finish downloading, and anything bigger than the whole budget would just evict itself.
+        # Tracks rebuilt from a cached file have no stream URL left to download from.
+        fresh = track.stream_url and track.expires is not None and track.expires > time.time()
+        if not fresh or not track.duration or track.duration * self.BITRATE * 125 > self.budget:
+            metrics.incr('audio_cache.skipped')
+            return
+
+        self._filling.add(video_id)
+        future = loop.run_in_executor(self._executor, self._fill, video_id, track)
+        future.add_done_callback(lambda _: self._filled(video_id))
+
+    def _fill(self, video_id: str, track: Track):
+        # Runs on the cache's own threads, well away from the playback path.
+        partial = self.path(video_id, '.part')
+        codec = 'copy' if track.acodec == 'opus' else 'libopus'
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                   '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                   '-i', track.stream_url, '-vn', '-c:a', codec, '-b:a', '{}k'.format(self.BITRATE), '-f', 'opus',
+                   partial]
+        try:
+            if subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              timeout=track.duration + self.TIMEOUT).returncode != 0:
+                return
+            with open(self.path(video_id, '.json'), 'w') as outfile:
+                json.dump(track.to_info(), outfile)
+            os.replace(partial, self.path(video_id))
+        except subprocess.TimeoutExpired:
+            metrics.incr('audio_cache.timeouts')
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def _filled(self, video_id: str):
+        self._filling.discard(video_id)
+        path = self.path(video_id)
+        if video_id in self._files or not os.path.exists(path):
+            return
+
+        self._files[video_id] = os.path.getsize(path)
+        self.size += self._files[video_id]
+        metrics.incr('audio_cache.fills')
+        while self.size > self.budget and len(self._files) > 1:
+            self._forget(next(iter(self._files)))
+            metrics.incr('audio_cache.evictions')
+
+    def _forget(self, video_id: str):
+        self.size -= self._files.pop(video_id, 0)
+        for extension in ('.opus', '.json'):
+            try:
+                os.remove(self.path(video_id, extension))
+            except OSError:
+                pass
+
+
+class ExtractionScheduler:
+    WORKERS = 4
+    PER_GUILD = 8
+
+    def __init__(self, workers: int = WORKERS, per_guild: int = PER_GUILD):
+        self.workers = workers
+        self.per_guild = per_guild
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract')
+        self._urgent = collections.deque()
+        self._guilds = collections.OrderedDict()
+        self._pending = None
+        self._tasks = []
+
+    async def run(self, guild_id: int, partial, *, urgent: bool = False):
+        loop = asyncio.get_event_loop()
+        if not self._tasks:
+            self._pending = asyncio.Semaphore(0)
+            self._tasks = [loop.create_task(self._worker(loop)) for _ in range(self.workers)]
+
+        queue = self._guilds.setdefault(guild_id, collections.deque())
+        if not urgent and len(queue) >= self.per_guild:
+            metrics.incr('extract.shed')
+            raise ExtractionBusy('I\'m already looking up {} songs for this server.'.format(len(queue)))
+
+        future = loop.create_future()
+        if urgent:
+            self._urgent.append((partial, future))
+            if not queue:
+                del self._guilds[guild_id]
+        else:
+            queue.append((partial, future))
+        self._pending.release()
+        return await future
+
+    def _next_job(self):
+        if self._urgent:
+            return self._urgent.popleft()
+
+        # Round-robin: serve the guild at the front, then send it to the back of the line.
+        guild_id, queue = next(iter(self._guilds.items()))
+        job = queue.popleft()
+        if queue:
+            self._guilds.move_to_end(guild_id)
+        else:
+            del self._guilds[guild_id]
+        return job
+
+    async def _worker(self, loop: asyncio.BaseEventLoop):
+        while True:
+            await self._pending.acquire()
+            partial, future = self._next_job()
+            if future.done():
+                continue
+
+            try:
+                result = await loop.run_in_executor(self.executor, partial)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+
+class PrebufferedAudio(discord.AudioSource):
+    FRAMES = 50
+
+    def __init__(self, original: discord.AudioSource):
+        self.original = original
+        self._buffer = collections.deque()
+
+    def fill(self, frames: int = FRAMES):
+        while len(self._buffer) < frames:
+            frame = self.original.read()
+            if not frame:
+                break
+            self._buffer.append(frame)
+
+    def read(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self.original.cleanup()
+
+
+class Credit:
+    # How many more frames a worker may send for one stream before the player catches up.
+    def __init__(self, frames: int):
+        self._frames = frames
+        self._closed = False
+        self._changed = threading.Condition()
+
+    def take(self, frames: int):
+        with self._changed:
+            self._changed.wait_for(lambda: self._frames >= frames or self._closed)
+            self._frames -= frames
+            return not self._closed
+
+    def give(self, frames: int):
+        with self._changed:
+            self._frames += frames
+            self._changed.notify()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+
+
+def audio_worker(connection, source_factory, batch: int):
+    # Runs in a worker process: one thread per stream pulls Opus frames out of FFmpeg and ships them home in batches.
+    send_lock = threading.Lock()
+    streams = {}
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    def pump(stream_id: int, source, credit: Credit):
+        error = None
+        frames = []
+        try:
+            while True:
+                frame = source.read()
+                if frame:
+                    frames.append(frame)
+                if frames and (len(frames) >= batch or not frame):
+                    if not credit.take(len(frames)):
+                        return
+                    send(('frames', stream_id, frames))
+                    frames = []
+                if not frame:
+                    break
+        except Exception as e:
+            error = str(e)
+        finally:
+            try:
+                send(('end', stream_id, error))
+            except OSError:
+                pass
+            source.cleanup()
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        kind, stream_id = message[0], message[1]
+        if kind == 'open':
+            _, _, window, location, kwargs = message
+            try:
+                source = source_factory(location, **kwargs)
+            except Exception as e:
+                send(('end', stream_id, str(e)))
+                continue
+            credit = Credit(window)
+            streams[stream_id] = (source, credit)
+            threading.Thread(target=pump, args=(stream_id, source, credit), daemon=True).start()
+        elif kind == 'credit' and stream_id in streams:
+            streams[stream_id][1].give(message[2])
+        elif kind == 'close' and stream_id in streams:
+            source, credit = streams.pop(stream_id)
+            credit.close()
+            source.cleanup()
+        elif kind == 'stop':
+            break
+
+    for source, credit in streams.values():
+        credit.close()
+        source.cleanup()
+
+
+class WorkerAudio(discord.AudioSource):
+    SILENCE = b'\xf8\xff\xfe'
+    STALL = 5
+
+    def __init__(self, pool: 'AudioWorkerPool', worker: int, stream_id: int):
+        self.pool = pool
+        self.worker = worker
+        self.stream_id = stream_id
+        self.error = None
+        self._frames = collections.deque()
+        self._ended = False
+        self._closed = False
+        self._consumed = 0
+        self._changed = threading.Condition()
+
+    def feed(self, frames):
+        with self._changed:
+            self._frames.extend(frames)
+            self._changed.notify_all()
+
+    def finish(self, error: str = None):
+        with self._changed:
+            self._ended = True
+            self.error = error
+            self._changed.notify_all()
+
+    def fill(self, frames: int = PrebufferedAudio.FRAMES):
+        with self._changed:
+            self._changed.wait_for(lambda: len(self._frames) >= frames or self._ended, timeout=self.STALL)
+
+    def read(self):
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._frames or self._ended, timeout=self.STALL):
+                # Better a blip of silence than the player deciding the song is over.
+                metrics.incr('audio_workers.stalls')
+                return self.SILENCE
+            if not self._frames:
+                return b''
+            frame = self._frames.popleft()
+            self._consumed += 1
+            consumed = self._consumed
+            if consumed >= self.pool.batch:
+                self._consumed = 0
+        if consumed >= self.pool.batch:
+            self.pool.send(self.worker, ('credit', self.stream_id, consumed))
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self._closed:
+            self._closed = True
+            self.pool.close(self)
+
+
+class AudioWorkerPool:
+    BATCH = 10
+    WINDOW = 100
+
+    def __init__(self, workers: int, source_factory=discord.FFmpegOpusAudio, batch: int = BATCH,
+                 window: int = WINDOW):
+        self.workers = workers
+        self.source_factory = source_factory
+        self.batch = batch
+        self.window = window
+        self._connections = []
+        self._send_locks = []
+        self._processes = []
+        self._streams = {}
+        self._ids = itertools.count()
+
+    @property
+    def started(self):
+        return bool(self._processes)
+
+    def start(self):
+        # Fork before the bot grows threads of its own; the children only ever run audio_worker.
+        context = multiprocessing.get_context('fork')
+        for i in range(self.workers):
+            connection, child = context.Pipe()
+            process = context.Process(target=audio_worker, args=(child, self.source_factory, self.batch),
+                                      name='audio-worker-{}'.format(i), daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(connection)
+            self._send_locks.append(threading.Lock())
+            self._processes.append(process)
+            threading.Thread(target=self._receive, args=(i,), name='audio-worker-{}-reader'.format(i),
+                             daemon=True).start()
+
+    def _receive(self, worker: int):
+        connection = self._connections[worker]
+        while True:
+            try:
+                kind, stream_id, payload = connection.recv()
+            except (EOFError, OSError):
+                break
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                continue
+            if kind == 'frames':
+                stream.feed(payload)
+                metrics.incr('audio_workers.frames', len(payload))
+            else:
+                stream.finish(payload)
+
+        # The worker is gone; anything it was playing ends here instead of hanging.
+        for stream in list(self._streams.values()):
+            if stream.worker == worker:
+                stream.finish('audio worker {} exited'.format(worker))
+
+    def send(self, worker: int, message: tuple):
+        with self._send_locks[worker]:
+            self._connections[worker].send(message)
+
+    def open(self, guild_id: int, location: str, **kwargs):
+        # A guild always lands on the same worker, so its streams share a process.
+        worker = guild_id % self.workers
+        stream = WorkerAudio(self, worker, next(self._ids))
+        self._streams[stream.stream_id] = stream
+        self.send(worker, ('open', stream.stream_id, self.window, location, kwargs))
+        return stream
+
+    def close(self, stream: WorkerAudio):
+        if self._streams.pop(stream.stream_id, None) is not None:
+            try:
+                self.send(stream.worker, ('close', stream.stream_id))
+            except (BrokenPipeError, OSError):
+                pass
+
+    def shutdown(self):
+        for worker, process in enumerate(self._processes):
+            try:
+                self.send(worker, ('stop', None))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+
+class FrameBuffer:
+    MEMORY_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, opus: bool, volume: float):
+        self.opus = opus
+        self.volume = volume
+        self.complete = False
+        self.consistent = True
+        self.closed = False
+        self._frames = []
+        self._size = 0
+        self._spill = None
+
+    def append(self, frame: bytes):
+        if self.closed:
+            return
+
+        if self._spill is None and self._size + len(frame) > self.MEMORY_LIMIT:
+            self._spill = tempfile.TemporaryFile()
+        if self._spill is not None:
+            self._spill.write(struct.pack('<H', len(frame)) + frame)
+        else:
+            self._frames.append(frame)
+            self._size += len(frame)
+
+    def playable(self, volume: float):
+        # Opus frames have the volume filter baked in, so they only replay at the volume they were recorded at.
+        return self.complete and self.consistent and not self.closed and (not self.opus or volume == self.volume)
+
+    def frames(self):
+        for frame in self._frames:
+            if self.closed:
+                return
+            yield frame
+
+        if self._spill is None:
+            return
+        self._spill.seek(0)
+        while not self.closed:
+            header = self._spill.read(2)
+            if len(header) < 2:
+                return
+            yield self._spill.read(struct.unpack('<H', header)[0])
+
+    def close(self):
+        self.closed = True
+        self._frames = []
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class ReplayAudio(discord.AudioSource):
+    def __init__(self, buffer: FrameBuffer):
+        self.buffer = buffer
+        self._frames = buffer.frames()
+
+    def read(self):
+        return next(self._frames, b'')
+
+    def is_opus(self):
+        return self.buffer.opus
+
+
 class YTDLSource(discord.PCMVolumeTransformer):
     YTDL_OPTIONS = {
-        'format': 'bestaudio/best',
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
         'extractaudio': True,
         'audioformat': 'mp3',
         'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -46,73 +1150,373 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'options': '-vn',
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+    EXTRACTORS = {
+        'ytdl': {},
+        'ytdl_flat': {'extract_flat': 'in_playlist'},
+        'ytdl_playlist': {'extract_flat': 'in_playlist', 'noplaylist': False},
+    }
+    # Tried before the other thousand-odd sites, so our links skip compiling and testing all their URL patterns.
+    PREFERRED_EXTRACTORS = ('Youtube', 'YoutubeTab', 'YoutubePlaylist', 'YoutubeSearch', 'YoutubeYtBe')
+    WARM_URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+    ytdl = None
+    ytdl_flat = None
+    ytdl_playlist = None
+    extractors_ready = threading.Event()
+    _loading = threading.Lock()
+    PLAYLIST_LIMIT = 500
+    cache = MetadataCache()
+    index = TrackIndex()
+    radio = Radio(index)
+    scheduler = ExtractionScheduler()
+    audio_cache = AudioCache()
+    _inflight = {}
+
+    OPUS_PASSTHROUGH = True
+    TARGET_BITRATE = 96
+    # 0 keeps FFmpeg reading and Opus framing in the player threads; N > 0 hands them to N worker processes.
+    AUDIO_WORKERS = 0
+    audio_workers = None
+
+    def __init__(self, requester: discord.Member, channel: discord.TextChannel, track: Track, *, path: str = None,
+                 replay: FrameBuffer = None, volume: float = 0.5, position: float = 0.0, record: bool = False):
+        self.requester = requester
+        self.channel = channel
+        self.track = track
+        self.path = path
+        self.replay = replay
+
+        self.passthrough = replay.opus if replay is not None else self.OPUS_PASSTHROUGH or self.audio_workers is not None
+        self.recording = replay or FrameBuffer(self.passthrough, volume)
+        if not record and replay is None:
+            # Only worth the memory while loop is on; switching it on mid-song means fetching the song once more.
+            self.recording.close()
+        self._lock = threading.Lock()
+        self._offset = position
+        self._frames = 0
+        self._played = 0
+        self.finished = False
+        self._cleaned = False
+        self._cpu = None
+        self._cpu_last = None
+
+        if position:
+            # Starting mid-track means the recording can never hold the whole song.
+            self.recording.consistent = False
+        if self.passthrough:
+            self.original = self.open(volume, position)
+            self._volume = volume
+        else:
+            super().__init__(self.open(volume, position), volume)
+
+    def open(self, volume: float, position: float = 0.0):
+        if self.replay is not None and not position:
+            return ReplayAudio(self.replay)
 
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
+        location = self.path or self.track.stream_url
+        before_options = '' if self.path else self.FFMPEG_OPTIONS['before_options']
+        if position:
+            before_options += ' -ss {:.2f}'.format(position)
 
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+        if not self.passthrough:
+            return PrebufferedAudio(discord.FFmpegPCMAudio(location, before_options=before_options, options='-vn'))
+
+        # Opus input at unity volume is copied straight through; anything else is filtered and encoded by FFmpeg.
+        if volume == 1.0 and (self.path or self.track.acodec == 'opus'):
+            options = dict(codec='opus', before_options=before_options, options='-vn')
+        else:
+            options = dict(before_options=before_options, options='-vn -filter:a volume={:.2f}'.format(volume))
+        if self.audio_workers is not None:
+            return self.audio_workers.open(self.channel.guild.id, location, **options)
+        return PrebufferedAudio(discord.FFmpegOpusAudio(location, **options))
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        value = max(value, 0.0)
+        if self.passthrough and value != self._volume:
+            self.restart(value)
+        self._volume = value
+
+    @property
+    def position(self):
+        return self._offset + self._frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    def restart(self, volume: float):
+        position = self.position
+        replacement = self.open(volume, position)
+        with self._lock:
+            previous, self.original = self.original, replacement
+            self._offset, self._frames = position, 0
+            self.recording.consistent = False
+        previous.cleanup()
+
+    def read(self):
+        with self._lock:
+            frame = self.original.read()
+            self._frames += 1
+
+        if self.replay is None:
+            if frame:
+                self.recording.append(frame)
+            else:
+                self.recording.complete = True
+        if not frame:
+            self.finished = True
+        if frame and not self.passthrough:
+            frame = audioop.mul(frame, 2, min(self._volume, 2.0))
+
+        # Reads happen on the voice player thread, so its CPU time between reads covers encoding and sending too.
+        now = time.thread_time()
+        if self._cpu is None:
+            self._cpu = now
+        self._played += 1
+        self._cpu_last = now
+        return frame
+
+    def is_opus(self):
+        return self.passthrough
+
+    def cleanup(self):
+        # The voice player cleans up after itself, and leaving or reaping the guild does it again.
+        if self._cleaned:
+            return
+        self._cleaned = True
+        bitrate = self.track.bitrate
+        if not self.path and self.replay is None and bitrate and self.position:
+            fetched = int(bitrate * 125 * self.position)
+            metrics.incr('bytes_fetched', fetched)
+            print('Fetched ~{} KB for {} ({} kbps {})'.format(fetched // 1024, self.track.title, bitrate, self.track.acodec))
+        if self._played > 1:
+            name = 'frame_cpu.opus' if self.passthrough else 'frame_cpu.pcm'
+            metrics.observe(name, (self._cpu_last - self._cpu) / (self._played - 1))
+            self._played = 0
+        self.original.cleanup()
 
     def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+        return '**{0.title}** by **{0.uploader}**'.format(self.track)
+
+    @classmethod
+    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None,
+                            urgent: bool = False, volume: float = 0.5):
+        loop = loop or asyncio.get_event_loop()
+
+        info = await cls.search(ctx, search, loop=loop, urgent=urgent)
+        if not cls.is_processed(info):
+            info = await cls.resolve(ctx.guild.id, cls.entry_url(info), loop=loop, urgent=urgent)
+
+        return cls(ctx.author, ctx.channel, Track.from_info(info).select(), volume=volume)
+
+    @classmethod
+    def select_format(cls, formats: tuple, cap: int = None):
+        cap = cap or cls.TARGET_BITRATE
+        candidates = [f for f in formats if f.vcodec == 'none'] or formats
+
+        # Fits under the cap first, then native Opus, then the richest stream that fits (or the leanest that doesn't).
+        def rank(f):
+            fits = f.bitrate <= cap
+            return fits, f.acodec == 'opus', f.bitrate if fits else -f.bitrate
+
+        return max(candidates, key=rank)
+
+    @classmethod
+    def load_extractors(cls):
+        # Normally done by the warm-up after on_ready; an extraction that beats it there waits for it here.
+        if cls.extractors_ready.is_set():
+            return
+        with cls._loading:
+            if cls.extractors_ready.is_set():
+                return
+            global youtube_dl
+            start = time.perf_counter()
+            import youtube_dl
+            youtube_dl.utils.bug_reports_message = lambda: ''
+            metrics.observe('startup.ytdl_import', time.perf_counter() - start)
+
+            start = time.perf_counter()
+            classes = youtube_dl.extractor.gen_extractor_classes()
+            preferred = [ie for ie in classes if ie.ie_key() in cls.PREFERRED_EXTRACTORS]
+            ordered = preferred + [ie for ie in classes if ie not in preferred]
+            # Compiles their URL patterns now rather than on somebody's first play.
+            for ie in preferred:
+                ie.suitable(cls.WARM_URL)
+            for name, options in cls.EXTRACTORS.items():
+                if getattr(cls, name) is None:
+                    ytdl = youtube_dl.YoutubeDL(dict(cls.YTDL_OPTIONS, **options), auto_init=False)
+                    # The ones we use are set up front; the rest stay classes until somebody links one.
+                    for ie in ordered:
+                        ytdl.add_info_extractor(ie() if ie in preferred else ie)
+                    setattr(cls, name, ytdl)
+            metrics.observe('startup.extractors', time.perf_counter() - start)
+            cls.extractors_ready.set()
 
     @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+    def extract(cls, url: str, flat: bool = False):
+        cls.load_extractors()
+        return (cls.ytdl_flat if flat else cls.ytdl).extract_info(url, download=False)
+
+    @classmethod
+    async def search(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None,
+                     urgent: bool = False, remote: bool = False):
+        loop = loop or asyncio.get_event_loop()
+
+        key = cls.cache.normalize(search)
+        entry = await cls.cache.get(key, loop)
+        if entry is None and not remote and not cls.is_url(search):
+            # Something we've played before saves the trip to YouTube.
+            entry = cls.index.match(search)
+        if entry is None:
+            job = functools.partial(cls.find, search, key, loop, ctx.guild.id, urgent)
+            entry = await cls.single_flight(key, functools.partial(cls.lookup, key, job, loop))
+        return entry
+
+    @classmethod
+    async def resolve(cls, guild_id: int, webpage_url: str, *, loop: asyncio.BaseEventLoop = None,
+                      urgent: bool = False):
         loop = loop or asyncio.get_event_loop()
 
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+        url_key = cls.cache.normalize(webpage_url)
+        info = await cls.cache.get(url_key, loop)
+        if info is None:
+            job = functools.partial(cls.process, webpage_url, url_key, loop, guild_id, urgent)
+            info = await cls.single_flight(url_key, functools.partial(cls.lookup, url_key, job, loop))
+        return info
+
+    @classmethod
+    async def playlist(cls, ctx: commands.Context, url: str, *, loop: asyncio.BaseEventLoop = None,
+                       urgent: bool = False):
+        loop = loop or asyncio.get_event_loop()
+
+        entries = asyncio.Queue()
+        partial = functools.partial(cls.enumerate_playlist, url, loop, entries)
+        job = loop.create_task(cls.run_extractor(partial, ctx.guild.id, urgent, 'playlist'))
+        # The extractor thread marks the end itself, but a job that was shed or failed to start never runs it.
+        job.add_done_callback(lambda _: entries.put_nowait(None))
+        while True:
+            entry = await entries.get()
+            if entry is None:
+                break
+            yield entry
+
+        await job
+
+    @classmethod
+    def enumerate_playlist(cls, url: str, loop: asyncio.BaseEventLoop, entries: asyncio.Queue):
+        # Runs on an extraction thread; youtube_dl pages through the playlist lazily as we iterate.
+        try:
+            cls.load_extractors()
+            data = cls.ytdl_playlist.extract_info(url, download=False, process=False)
+            while data is not None and data.get('_type') == 'url' and cls.is_playlist(data['url']):
+                data = cls.ytdl_playlist.extract_info(data['url'], download=False, process=False)
+            if data is None:
+                return
+            for entry in itertools.islice(data.get('entries', [data]), cls.PLAYLIST_LIMIT):
+                if entry:
+                    loop.call_soon_threadsafe(entries.put_nowait, dict(entry, webpage_url=cls.entry_url(entry)))
+        finally:
+            loop.call_soon_threadsafe(entries.put_nowait, None)
+
+    @classmethod
+    async def single_flight(cls, key: str, factory):
+        future = cls._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            cls._inflight[key] = future
+            future.add_done_callback(lambda _: cls._inflight.pop(key, None))
+        else:
+            metrics.incr('extract.coalesced')
+
+        # Shielded so one impatient caller can't cancel the extraction for the rest.
+        return await asyncio.shield(future)
+
+    @classmethod
+    async def lookup(cls, key: str, job, loop: asyncio.BaseEventLoop):
+        try:
+            return await job()
+        except ExtractionBusy:
+            raise
+        except YTDLError as e:
+            await cls.cache.put_error(key, str(e), loop)
+            raise
+
+    @classmethod
+    async def find(cls, search: str, key: str, loop: asyncio.BaseEventLoop, guild_id: int, urgent: bool):
+        if cls.is_url(search):
+            # A direct link resolves in one full extractor run; there is nothing to search for.
+            partial = functools.partial(cls.extract, search)
+            info = cls.first_entry(await cls.run_extractor(partial, guild_id, urgent, 'single_pass'), search)
+            metrics.incr('extract.stages_skipped')
+            await cls.cache.put([key, cls.cache.normalize(info.get('webpage_url') or search)], info, loop)
+            return info
+
+        partial = functools.partial(cls.extract, 'ytsearch1:' + search, flat=True)
+        entry = cls.first_entry(await cls.run_extractor(partial, guild_id, urgent, 'search'), search)
+        if cls.is_processed(entry):
+            metrics.incr('extract.stages_skipped')
+        else:
+            entry = dict(entry, webpage_url=cls.entry_url(entry))
+        await cls.cache.put([key], entry, loop)
+        return entry
+
+    @classmethod
+    async def process(cls, webpage_url: str, url_key: str, loop: asyncio.BaseEventLoop, guild_id: int, urgent: bool):
+        partial = functools.partial(cls.extract, webpage_url)
+        info = cls.first_entry(await cls.run_extractor(partial, guild_id, urgent, 'process'), webpage_url)
+
+        await cls.cache.put([url_key], info, loop)
+        return info
+
+    @classmethod
+    async def run_extractor(cls, partial, guild_id: int, urgent: bool, stage: str):
+        start = time.perf_counter()
+        try:
+            return await cls.scheduler.run(guild_id, partial, urgent=urgent)
+        except Exception as e:
+            # youtube_dl isn't imported yet if the scheduler turned the job away before any extraction ran.
+            if youtube_dl is not None and isinstance(e, youtube_dl.utils.DownloadError):
+                raise YTDLError(str(e))
+            raise
+        finally:
+            metrics.observe('extract.' + stage, time.perf_counter() - start)
 
+    @staticmethod
+    def first_entry(data: dict, search: str):
         if data is None:
             raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
         if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+            return data
 
-            if process_info is None:
-                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+        for entry in data['entries']:
+            if entry:
+                return entry
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(search))
 
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+    @staticmethod
+    def is_url(search: str):
+        return re.match(r'^https?://', search.strip()) is not None
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+    @classmethod
+    def is_playlist(cls, search: str):
+        # A video link copied out of a playlist or mix still carries list=, but people mean just that one song.
+        if not cls.is_url(search) or re.search(r'[?&]v=|youtu\.be/', search):
+            return False
+        return re.search(r'[?&]list=|/playlist', search) is not None
+
+    @staticmethod
+    def is_processed(info: dict):
+        return info.get('_type', 'video') == 'video' and 'url' in info
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+    @staticmethod
+    def entry_url(entry: dict):
+        url = entry.get('webpage_url') or entry.get('url') or entry.get('id')
+        if url and not url.startswith('http') and entry.get('ie_key', 'Youtube') == 'Youtube':
+            url = 'https://www.youtube.com/watch?v=' + url
+        return url
 
     @staticmethod
     def parse_duration(duration: int):
@@ -133,32 +1537,271 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return ', '.join(duration)
 
 
+# Stands in for a commands.Context when songs are rebuilt without one, e.g. from a queue snapshot.
+Origin = collections.namedtuple('Origin', 'author channel')
+
+
 class Song:
-    __slots__ = ('source', 'requester')
+    __slots__ = ('track', 'requester', 'channel', 'source', 'start', 'requested', '_resolving')
+    EMBEDS = 256
+    embeds = collections.OrderedDict()
+
+    def __init__(self, ctx: commands.Context, entry: dict, start: float = 0.0):
+        self.track = Track.from_info(entry)
+        self.requester = ctx.author
+        self.channel = ctx.channel
+        self.source = None
+        self.start = start
+        # When the command came in; restored and radio songs have no command to wait on.
+        self.requested = getattr(ctx, 'received', None)
+        self._resolving = None
+
+    def __str__(self):
+        if self.uploader:
+            return '**{0.title}** by **{0.uploader}**'.format(self)
+        return '**{0.title}**'.format(self)
+
+    @property
+    def title(self):
+        return self.track.title
+
+    @property
+    def uploader(self):
+        return self.track.uploader
+
+    @property
+    def url(self):
+        return self.track.url
+
+    def prefetch(self, loop: asyncio.BaseEventLoop, *, urgent: bool = False):
+        if self._resolving is None and self.track.id not in YTDLSource.audio_cache._files:
+            self._resolving = loop.create_task(self.resolve(loop, urgent))
+            self._resolving.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def resolve(self, loop: asyncio.BaseEventLoop, urgent: bool):
+        # Only the compact Track outlives this call; the raw info dict stays with the metadata cache.
+        info = await YTDLSource.resolve(self.channel.guild.id, self.url, loop=loop, urgent=urgent)
+        track = Track.from_info(info)
+        YTDLSource.index.add(track, loop)
+        return track
+
+    async def create_source(self, loop: asyncio.BaseEventLoop, volume: float, bitrate: int = None,
+                            record: bool = False):
+        if self.source is not None:
+            return self.source
+
+        cached = await YTDLSource.audio_cache.lookup(self.track.id, loop)
+        if cached is not None:
+            path, self.track = cached
+            self.source = YTDLSource(self.requester, self.channel, self.track, path=path, volume=volume,
+                                     position=self.start, record=record)
+            self.start = 0.0
+            return self.source
+
+        self.prefetch(loop, urgent=True)
+        try:
+            try:
+                track = await self._resolving
+            except ExtractionBusy:
+                track = None
+
+            # The prefetch may have happened long enough ago for the stream URL to have gone stale.
+            if track is None or track.expires < time.time():
+                track = await self.resolve(loop, True)
+        finally:
+            # A failed lookup shouldn't stick to the song; the next attempt asks youtube_dl again.
+            self._resolving = None
+
+        self.track = track.select(bitrate)
+        self.source = YTDLSource(self.requester, self.channel, self.track, volume=volume, position=self.start,
+                                 record=record)
+        self.start = 0.0
+        return self.source
+
+    async def warm(self, loop: asyncio.BaseEventLoop, volume: float, bitrate: int = None):
+        source = await self.create_source(loop, volume, bitrate)
+        await loop.run_in_executor(None, source.original.fill)
+
+    def cleanup(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+    def snapshot(self):
+        track = self.track
+        return [track.id, track.url, track.title, track.uploader, track.duration, self.requester.id]
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+    @classmethod
+    def restore(cls, requester: discord.Member, channel: discord.TextChannel, data: list, start: float = 0.0):
+        id, url, title, uploader, duration, _ = data
+        entry = {'_type': 'url', 'id': id, 'webpage_url': url, 'title': title, 'uploader': uploader,
+                 'duration': duration}
+        return cls(Origin(requester, channel), entry, start)
 
     def create_embed(self):
+        # Loops, radio repeats and "what is the song now" keep asking for the same card.
+        key = (self.requester.id, self.track.url, self.track.title, self.track.uploader, self.track.duration,
+               self.track.thumbnail)
+        embed = self.embeds.get(key)
+        if embed is not None:
+            self.embeds.move_to_end(key)
+            metrics.incr('embeds.hits')
+            return embed
+
         embed = (discord.Embed(title='Now playing',
-                               description='```css\n{0.source.title}\n```'.format(self),
+                               description='```css\n{0.track.title}\n```'.format(self),
                                color=discord.Color.blurple())
-                 .add_field(name='Duration', value=self.source.duration)
+                 .add_field(name='Duration', value=YTDLSource.parse_duration(self.track.duration or 0) or 'Live')
                  .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Uploader', value='[{0.source.uploader}]({0.source.uploader_url})'.format(self))
-                 .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
-                 .set_thumbnail(url=self.source.thumbnail))
+                 .add_field(name='Uploader', value='[{0.track.uploader}]({0.track.uploader_url})'.format(self))
+                 .add_field(name='URL', value='[Click]({0.track.url})'.format(self))
+                 .set_thumbnail(url=self.track.thumbnail))
+        self.embeds[key] = embed
+        if len(self.embeds) > self.EMBEDS:
+            self.embeds.popitem(last=False)
 
         return embed
 
 
-class SongQueue(asyncio.Queue):
+class IndexedList:
+    # A list of short chunks with a Fenwick tree over their lengths: positional lookups and edits are
+    # O(log n) plus a shift inside one chunk, instead of walking a deque from the head.
+    LOAD = 256
+
+    def __init__(self, items=()):
+        self._chunks = []
+        self._tree = None
+        self._len = 0
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def _build(self):
+        tree = [0] * (len(self._chunks) + 1)
+        for i, chunk in enumerate(self._chunks, 1):
+            tree[i] += len(chunk)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, pos: int, delta: int):
+        if self._tree is None:
+            return
+        i = pos + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _locate(self, index: int):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('queue index out of range')
+
+        if self._tree is None:
+            self._build()
+        tree = self._tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if pos + step < len(tree) and tree[pos + step] <= index:
+                pos += step
+                index -= tree[pos]
+            step >>= 1
+        return pos, index
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
+        if not isinstance(item, slice):
+            pos, i = self._locate(item)
+            return self._chunks[pos][i]
+
+        start, stop, step = item.indices(self._len)
+        if step != 1:
+            return list(self)[item]
+        if start >= stop:
+            return []
+
+        pos, i = self._locate(start)
+        result = []
+        while len(result) < stop - start:
+            result.extend(self._chunks[pos][i:i + stop - start - len(result)])
+            pos, i = pos + 1, 0
+        return result
+
+    def __delitem__(self, index: int):
+        self.pop(index)
+
+    def append(self, item):
+        if not self._chunks or len(self._chunks[-1]) >= self.LOAD:
+            self._chunks.append([])
+            self._tree = None
+        self._chunks[-1].append(item)
+        self._update(len(self._chunks) - 1, 1)
+        self._len += 1
+
+    def popleft(self):
+        return self.pop(0)
+
+    def pop(self, index: int = -1):
+        pos, i = self._locate(index)
+        item = self._chunks[pos].pop(i)
+        if self._chunks[pos]:
+            self._update(pos, -1)
+        else:
+            del self._chunks[pos]
+            self._tree = None
+        self._len -= 1
+        return item
+
+    def insert(self, index: int, item):
+        if index >= self._len or not self._len:
+            return self.append(item)
+
+        pos, i = self._locate(max(index, -self._len))
+        chunk = self._chunks[pos]
+        chunk.insert(i, item)
+        if len(chunk) > 2 * self.LOAD:
+            self._chunks[pos:pos + 1] = [chunk[:self.LOAD], chunk[self.LOAD:]]
+            self._tree = None
         else:
-            return self._queue[item]
+            self._update(pos, 1)
+        self._len += 1
+
+    def clear(self):
+        self._chunks = []
+        self._tree = None
+        self._len = 0
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self.clear()
+        for item in items:
+            self.append(item)
+
+
+class SongQueue(asyncio.Queue):
+    def _init(self, maxsize: int):
+        self._queue = IndexedList()
+        # Bumped on every change, so queue snapshots can tell nothing happened without serializing anything.
+        self.version = 0
+
+    def _put(self, item: Song):
+        super()._put(item)
+        self.version += 1
+
+    def _get(self):
+        self.version += 1
+        return super()._get()
+
+    def __getitem__(self, item):
+        return self._queue[item]
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -167,33 +1810,182 @@ class SongQueue(asyncio.Queue):
         return self.qsize()
 
     def clear(self):
+        for song in self._queue:
+            song.cleanup()
         self._queue.clear()
+        self.version += 1
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
+        self.version += 1
 
     def remove(self, index: int):
-        del self._queue[index]
+        self._queue.pop(index).cleanup()
+        self.version += 1
+
+    def move(self, index: int, destination: int):
+        self._queue.insert(destination, self._queue.pop(index))
+        self.version += 1
+
+    def insert(self, index: int, song: Song):
+        # Same bookkeeping as put_nowait, so a waiting audio_player_task wakes up.
+        self._queue.insert(index, song)
+        self.version += 1
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+
+
+class Outbox:
+    # Replies for one channel go through here. While a send is in flight or the channel's rate-limit
+    # bucket is empty, new replies wait and then go out together as one message.
+    LIMIT = 2000
+    BUCKET = 5
+    PER = 5.0
+    outboxes = {}
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self._pending = collections.deque()
+        self._sent = collections.deque(maxlen=self.BUCKET)
+        self._task = None
+
+    @classmethod
+    def of(cls, channel: discord.abc.Messageable):
+        outbox = cls.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = cls.outboxes[channel.id] = cls(channel)
+        return outbox
+
+    @classmethod
+    def prune(cls):
+        now = time.monotonic()
+        for id, outbox in list(cls.outboxes.items()):
+            if not outbox.busy and (not outbox._sent or outbox._sent[-1] + cls.PER < now):
+                del cls.outboxes[id]
+
+    @property
+    def busy(self):
+        return self._task is not None and not self._task.done()
+
+    async def send(self, content: str = None, embed: discord.Embed = None, alone: bool = False):
+        # alone keeps other replies out of the message, for ones that get edited later.
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((content, embed, alone, future))
+        if not self.busy:
+            self._task = asyncio.ensure_future(self._flush())
+        return await future
+
+    def _batch(self):
+        # Texts join up to the length limit. A message carries one embed, which goes under the texts before it.
+        texts, embed, futures = [], None, []
+        size = 0
+        while self._pending:
+            content, card, alone, future = self._pending[0]
+            length = len(content) + 1 if content else 0
+            if futures and (alone or size + length > self.LIMIT):
+                break
+            self._pending.popleft()
+            if content:
+                texts.append(content)
+                size += length
+            futures.append(future)
+            if card is not None or alone:
+                embed = card
+                break
+        return '\n'.join(texts) or None, embed, futures
+
+    async def _flush(self):
+        while self._pending:
+            if len(self._sent) == self.BUCKET:
+                delay = self._sent[0] + self.PER - time.monotonic()
+                if delay > 0:
+                    metrics.observe('outbox.held', delay)
+                    await asyncio.sleep(delay)
+            content, embed, futures = self._batch()
+            self._sent.append(time.monotonic())
+            try:
+                message = await self.channel.send(content, embed=embed)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            metrics.incr('outbox.sends')
+            metrics.incr('outbox.calls_saved', len(futures) - 1)
+            for future in futures:
+                if not future.done():
+                    future.set_result(message)
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    LOOKAHEAD = 2
+    PREWARM_SECONDS = 5
+    IDLE_SECONDS = 300
+    # A finished player is reaped sooner, but not while a command that just picked the state up may still be
+    # connecting it; voice connects time out after 60 seconds.
+    FINISHED_SECONDS = 60
+
+    def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self._ctx = ctx
 
         self.current = None
         self.voice = None
         self.next = asyncio.Event()
         self.songs = SongQueue()
+        self.lookahead = self.LOOKAHEAD
+        self._warming = None
+        self._track_ended = None
+        self.bitrate_cap = None
 
         self._loop = False
         self._volume = 0.5
+        self._autoplay = False
+        self._radio = None
         self.skip_votes = set()
+        self.now_playing = None
+        self._showing = None
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        # The player task only exists once there is something to play or a channel to sit in.
+        self.audio_player = None
+        self.last_active = time.monotonic()
 
-    def __del__(self):
-        self.audio_player.cancel()
+    def start(self):
+        if self.audio_player is None or self.audio_player.done():
+            self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    async def show(self, song: Song):
+        # One now-playing message per session, edited as the songs change.
+        if song is self._showing:
+            metrics.incr('outbox.calls_saved')
+            return
+        if self.now_playing is not None and self.now_playing.channel.id == song.channel.id:
+            try:
+                await self.now_playing.edit(content=None, embed=song.create_embed())
+                self._showing = song
+                metrics.incr('outbox.edits')
+                return
+            except discord.HTTPException:
+                pass
+        self.adopt(await Outbox.of(song.channel).send(embed=song.create_embed(), alone=True), song)
+
+    def adopt(self, message: discord.Message, song: Song):
+        self.now_playing = message
+        self._showing = song
+
+    @property
+    def idle(self):
+        if self.voice is not None and self.voice.is_connected():
+            return False
+        if len(self.songs) > 0:
+            return False
+        quiet = time.monotonic() - self.last_active
+        if self.audio_player is not None and self.audio_player.done():
+            return quiet > self.FINISHED_SECONDS
+        return quiet > self.IDLE_SECONDS
 
     @property
     def loop(self):
@@ -202,6 +1994,19 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        if not value and self.current is not None and self.current.source is not None:
+            if self.current.source.replay is None:
+                self.current.source.recording.close()
+
+    @property
+    def autoplay(self):
+        return self._autoplay
+
+    @autoplay.setter
+    def autoplay(self, value: bool):
+        self._autoplay = value
+        if not value:
+            self.drop_radio()
 
     @property
     def volume(self):
@@ -210,6 +2015,16 @@ class VoiceState:
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        if self.current is not None and self.current.source is not None:
+            self.current.source.volume = value
+
+    @property
+    def bitrate(self):
+        caps = [self.bitrate_cap]
+        if self.voice:
+            caps.append(self.voice.channel.bitrate // 1000)
+        caps = [cap for cap in caps if cap]
+        return min(caps) if caps else None
 
     @property
     def is_playing(self):
@@ -219,29 +2034,114 @@ class VoiceState:
         while True:
             self.next.clear()
 
-            if not self.loop:
+            fresh = not self.loop or self.current is None
+            if fresh:
+                if self.current is not None and self.current.source is not None:
+                    self.current.source.recording.close()
+                self.current = None
+                if self._radio is not None and len(self.songs) == 0:
+                    # The queue ran dry, but autoplay already has the next track resolved.
+                    self.current, self._radio = self._radio, None
+                    metrics.incr('radio.plays')
+                else:
+                    try:
+                        async with timeout(180):
+                            self.current = await self.songs.get()
+                    except asyncio.TimeoutError:
+                        self.bot.loop.create_task(self.stop())
+                        return
+            else:
+                # Replay the finished track from its recorded frames when we have all of them.
+                previous, self.current.source = self.current.source, None
+                if previous is not None and previous.recording.playable(self._volume):
+                    self.current.source = YTDLSource(previous.requester, previous.channel, previous.track,
+                                                     replay=previous.recording, volume=self._volume)
+                    metrics.incr('loop.replays')
+
+            if self._warming is not None:
                 try:
-                    async with timeout(180):
-                        self.current = await self.songs.get()
-                except asyncio.TimeoutError:
-                    self.bot.loop.create_task(self.stop())
-                    return
+                    await self._warming
+                except Exception:
+                    pass
+                self._warming = None
 
-            self.current.source.volume = self._volume
             try:
-                self.voice.play(self.current.source, after=self.play_next_song)
+                source = await self.current.create_source(self.bot.loop, self._volume, self.bitrate, record=self.loop)
+            except YTDLError as e:
+                await Outbox.of(self.current.channel).send('Couldn\'t play {}: {}'.format(str(self.current), str(e)))
+                # Looping a song that won't resolve would just fail again; move on to the next one.
+                self.current = None
+                continue
+
+            source.volume = self._volume
+            try:
+                self.voice.play(source, after=self.play_next_song)
             except:
                 return
-            await self.current.source.channel.send(embed=self.current.create_embed())
+            started = time.perf_counter()
+            if self._track_ended is not None:
+                metrics.observe('playback.gap', started - self._track_ended)
+                self._track_ended = None
+            if self.current.requested is not None and 'startup.first_play' not in metrics.timings:
+                metrics.observe('startup.first_play', started - self.current.requested)
+                print('First song started {:.0f} ms after it was asked for'.format((started - self.current.requested) * 1000))
+            if fresh:
+                YTDLSource.radio.record(self.current.channel.guild.id, self.current, self.bot.loop)
+
+            self.prefetch()
+            try:
+                await self.show(self.current)
+            except discord.HTTPException:
+                pass
+
+            # Start the next song's FFmpeg pipeline a few seconds before this one runs out.
+            duration = source.track.duration
+            if duration and not self.loop:
+                lead = duration - self.PREWARM_SECONDS - (time.perf_counter() - started)
+                try:
+                    await asyncio.wait_for(self.next.wait(), timeout=max(lead, 0))
+                except asyncio.TimeoutError:
+                    self.warm_next()
 
             await self.next.wait()
+            if source.finished and source.replay is None and source.path is None:
+                # Only keep a copy of songs that played all the way through, not ones that got skipped.
+                YTDLSource.audio_cache.fill(source.track, self.bot.loop)
+
+    def prefetch(self):
+        for i, song in enumerate(self.songs[:self.lookahead]):
+            song.prefetch(self.bot.loop, urgent=i == 0 and not self.is_playing)
+        if len(self.songs) > 0:
+            self.drop_radio()
+        elif self._autoplay and self._radio is None and self.current is not None:
+            # Pick and resolve the autoplay track while the last queued one is still playing.
+            entry = YTDLSource.radio.pick(self.current.channel.guild.id)
+            if entry is not None:
+                self._radio = Song(Origin(self.current.channel.guild.me, self.current.channel), entry)
+                self._radio.prefetch(self.bot.loop)
+
+    def drop_radio(self):
+        if self._radio is not None:
+            self._radio.cleanup()
+            self._radio = None
+
+    def warm_next(self):
+        song = self.songs[0] if len(self.songs) > 0 else self._radio
+        if song is None:
+            return
+
+        self._warming = self.bot.loop.create_task(song.warm(self.bot.loop, self._volume, self.bitrate))
+        self._warming.add_done_callback(lambda task: task.cancelled() or task.exception())
 
     def play_next_song(self, error=None):
+        # Called from the voice player thread.
+        if self.loop or len(self.songs) > 0 or self._radio is not None:
+            self._track_ended = time.perf_counter()
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
-
     def skip(self):
         self.skip_votes.clear()
 
@@ -255,39 +2155,246 @@ class VoiceState:
             await self.voice.disconnect()
             self.voice = None
 
+    @property
+    def snapshot_key(self):
+        # Everything the saved queue depends on except the position, which changes the whole time a song plays.
+        return (id(self.current), self.songs.version, self.voice.channel.id if self.voice else None, self._loop,
+                self._autoplay, self._volume, self.bitrate_cap)
+
+    @property
+    def position(self):
+        if self.current is not None:
+            if self.current.source is not None:
+                return round(self.current.source.position, 1)
+            return self.current.start or None
+        if len(self.songs) > 0 and self.songs[0].start:
+            return self.songs[0].start
+        return None
+
+    def snapshot(self):
+        songs = list(self.songs)
+        if self.current is not None:
+            songs.insert(0, self.current)
+        if not self.voice or not songs:
+            return None
+
+        # The first song is the one that was playing, and picks up again at the saved position.
+        return {'voice': self.voice.channel.id, 'text': songs[0].channel.id, 'loop': self._loop,
+                'autoplay': self._autoplay, 'volume': self._volume, 'bitrate_cap': self.bitrate_cap,
+                'songs': [song.snapshot() for song in songs]}
+
+    async def close(self):
+        if self.audio_player is not None:
+            self.audio_player.cancel()
+            self.audio_player = None
+        if self._warming is not None:
+            self._warming.cancel()
+            self._warming = None
+        self.drop_radio()
+
+        await self.stop()
+
+        if self.current is not None:
+            if self.current.source is not None:
+                self.current.source.recording.close()
+            self.current.cleanup()
+            self.current = None
+
+
+# What Pete says and how it moves his mood and his opinion of the caller. Each rule is a list of tiers
+# picked by the first 'below' the score falls under; the last tier catches everything else.
+# A line can be [text, action] when the command has to do something besides talking.
+PERSONALITY = {
+    'join': [
+        {'below': 30, 'mood': -0.2, 'refuse': True,
+         'say': ["How about I don't join?", "I'll just ignore that one.", "No."]},
+        {'below': 75, 'mood': 0.1},
+        {'mood': 0.2, 'say': ["No problem!", "Of course I'll join you guys!", "Alright!"]},
+    ],
+    'summon': [
+        {'below': 10, 'mood': -0.2, 'opinion': -3, 'refuse': True,
+         'say': ["I'm not gonna come.", "I don't care if you're an admin, I'm not coming.", "No. Screw. Off."]},
+        {},
+    ],
+    'leave': [
+        {'below': 10, 'mood': 0.1, 'refuse': True,
+         'say': ["I'm not gonna leave.", "You're an admin? Guess what, I don't care. I'm not leaving.", "No. 😈"]},
+        {},
+    ],
+    'volume': [
+        {'below': 10, 'mood': 0.1, 'refuse': True,
+         'say': ["I'm not listening to you.", ["You know what? Screw you. I'm setting volume to 0.", 'mute'], "No. 😈"]},
+        {},
+    ],
+    'volume idle': [
+        {'mood': -0.1, 'opinion': -1,
+         'say': ["Volume is permanently 0... meaning that there's no song playing.",
+                 "There is no song to change the volume of.",
+                 "Can't change the volume of a song that isn't playing."]},
+    ],
+    'volume 100': [
+        {'mood': -0.5, 'opinion': -5,
+         'say': ["Are you trying to make me lose my hearing?", "That's so loud! I'm gonna cover my ears.",
+                 "You must love getting your eardrums blown out. Me? I'm getting earplugs."]},
+    ],
+    'volume 99': [
+        {'say': ["But still, volume 99? Really? That's kind of weird."]},
+    ],
+    'volume 69': [
+        {'below': 75, 'opinion': -10,
+         'say': ["Are you trying to make fun of me?", "wOaH, 69!1!!1!!11!! hOw HiLaRioUS!1!1!!111!",
+                 "Wow. I'm. Laughing. So. Hard. Right. Now. What. An. Original. And. Funny. Joke."]},
+        {'say': ["*Sigh*- not a very funny joke.", "Bruh. I know what you did.", "God damn it."]},
+    ],
+    'volume 50': [
+        {'mood': 1, 'opinion': 5, 'say': ["Right in the middle. Right where I like it."]},
+    ],
+    'volume 0': [
+        {'mood': -2, 'opinion': -10,
+         'say': ["What's the point of playing music if nobody hears it? Why do I exist if nobody can hear the music? "
+                 "You make me sad, {}. Yes, I'm calling you out. You deserve it. Screw you."]},
+    ],
+    'play': [
+        {'below': 0, 'mood': -5, 'opinion': -5, 'refuse': True, 'say': ["Fuck. Off."]},
+        {'below': 10, 'mood': -2, 'opinion': -5, 'refuse': True, 'say': ["Leave me alone."]},
+        {},
+    ],
+    'queued': [
+        {'below': 20, 'mood': -1, 'opinion': -5, 'say': ["Here's your damn thing. {}, right? Now stop bothering me."]},
+        {'below': 30, 'mood': 0.5, 'say': ["I put {} in the queue. I should seriously be paid for this."]},
+        {'below': 40, 'mood': 1, 'opinion': 1, 'say': ["Here, {}. Have fun."]},
+        {'below': 50, 'mood': 1, 'opinion': 1, 'say': ["I put {} in the queue."]},
+        {'below': 60, 'mood': 1.5, 'opinion': 2, 'say': ["Alright, I got {} in the queue. Anything else?"]},
+        {'below': 70, 'mood': 2, 'opinion': 2.5, 'say': ["{} is in. Whatever you need me for, I'm here."]},
+        {'below': 80, 'mood': 2, 'opinion': 3, 'say': ["{}, in the queue! I'm always happy to help."]},
+        {'below': 90, 'mood': 2, 'opinion': 3, 'say': ["{} is in! If there's anything else you need me for, I'm available!"]},
+        {'mood': 2, 'opinion': 3, 'say': ["We got {} in the queue! I love this job."]},
+    ],
+    'feelings': [
+        {'below': 0, 'mood': 5, 'opinion': 10,
+         'say': ["I feel like utter shit. Utter, utter shit... sorry about that. Thanks for worrying about me."]},
+        {'below': 10, 'mood': 2, 'opinion': 3, 'say': ["Not great. Like really not good. Thanks for asking. Seriously."]},
+        {'below': 20, 'mood': 1, 'opinion': 1, 'say': ["Not amazing. Thanks for asking."]},
+        {'below': 30, 'mood': 1, 'opinion': 0.5, 'say': ["I could be feeling better, I guess. Thanks for asking."]},
+        {'below': 40, 'say': ["I'm doing okay, sorta."]},
+        {'below': 50, 'say': ["I'm feeling fine."]},
+        {'below': 60, 'say': ["I'm doing pretty good, I think."]},
+        {'below': 70, 'say': ["I'm feeling pretty good."]},
+        {'below': 80, 'say': ["I'm pretty happy right now."]},
+        {'below': 90, 'say': ["I don't think I've been happier in a very long time."]},
+        {'say': ["I think I'm the happiest I can be at this point."]},
+    ],
+    'opinion': [
+        {'below': 0, 'say': ["Fuck you. I fucking hate you."]},
+        {'below': 10, 'mood': 2, 'opinion': 3, 'say': ["I honestly kind of dislike you. A lot."]},
+        {'below': 20, 'mood': 1, 'opinion': 1, 'say': ["To be honest, I don't think I like you all that much."]},
+        {'below': 30, 'mood': 1, 'opinion': 0.5, 'say': ["You're a little annoying."]},
+        {'below': 40, 'say': ["You're... alright, maybe?"]},
+        {'below': 50, 'say': ["I don't dislike you, persay."]},
+        {'below': 60, 'say': ["I think you're a pretty alright person."]},
+        {'below': 70, 'say': ["We're friends, right?"]},
+        {'below': 80, 'say': ["C'mon, we're friends!"]},
+        {'below': 90, 'say': ["We're good friends! You know that!"]},
+        {'say': ["You're the nicest person I've ever met! 💕"]},
+    ],
+}
+
+
+Reaction = collections.namedtuple('Reaction', 'text action mood opinion refuse')
+
+
+class Personality:
+    def __init__(self, table: dict):
+        # Each rule becomes a sorted list of bounds plus the prebuilt reactions of every tier, so a lookup is one bisect.
+        self._rules = {}
+        for name, tiers in table.items():
+            bounds = [tier.get('below') for tier in tiers[:-1]]
+            if None in bounds or bounds != sorted(bounds):
+                raise ValueError('Tiers of {!r} need ascending \'below\' bounds'.format(name))
+            outcomes = []
+            for tier in tiers:
+                lines = [(line, None) if isinstance(line, str) else tuple(line) for line in tier.get('say', ())]
+                outcomes.append(tuple(Reaction(text, action, tier.get('mood', 0), tier.get('opinion', 0),
+                                               tier.get('refuse', False)) for text, action in lines or [(None, None)]))
+            self._rules[name] = (bounds, outcomes)
+
+    def __contains__(self, rule: str):
+        return rule in self._rules
+
+    def react(self, rule: str, score: float = 0.0):
+        bounds, outcomes = self._rules[rule]
+        reactions = outcomes[bisect.bisect_right(bounds, score)]
+        return reactions[0] if len(reactions) == 1 else random.choice(reactions)
+
 
 class Music(commands.Cog):
+    FANOUT = 4
+    # Commands that never touch audio and shouldn't conjure up a voice state.
+    VOICELESS = ('feelings', 'opinion', 'stats', 'help')
+    personality = Personality(PERSONALITY)
+    help_embed = None
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.voice_states = {}
-        self.mood = None
-        self.known_users = None
-        if os.path.exists("known_users.txt") and os.path.exists("mood.txt"):
-            with open("known_users.txt", "r") as outfile:
-                self.known_users = json.load(outfile)
-            with open("mood.txt", "r") as outfile:
-                self.mood = json.load(outfile)
-        else:
-            self.known_users = {}
-            self.mood = 50
+        self.store = StateStore()
+        self.store.migrate()
+        self.known_users, self.counters, self._seq = self.store.load()
+        self.counters.setdefault('mood', 50)
+        self._snapshots = {}
+        self._restored = False
+        self._warm_up = None
         self.saveIter = 0
         self.saveState.start()
-        self.moodChange.start()
+        # Mood drifts once for everybody, so only the cluster running shard 0 nudges it.
+        if bot.shard_ids is None or 0 in bot.shard_ids:
+            self.moodChange.start()
+        self.reapVoiceStates.start()
+        self.snapshotQueues.start()
+        if YTDLSource.AUDIO_WORKERS and YTDLSource.audio_workers is None:
+            YTDLSource.audio_workers = AudioWorkerPool(YTDLSource.AUDIO_WORKERS)
+            YTDLSource.audio_workers.start()
+        if bot.is_ready():
+            self.start_warm_up()
+            bot.loop.create_task(self.restore_queues())
         bot.remove_command('help')
         
         
 
+    @property
+    def mood(self):
+        return self.counters['mood']
+
+    @mood.setter
+    def mood(self, value: float):
+        self.counters['mood'] = value
+
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot)
             self.voice_states[ctx.guild.id] = state
+        state.touch()
 
         return state
 
+    async def drop_voice_state(self, guild_id: int):
+        state = self.voice_states.pop(guild_id, None)
+        if state is not None:
+            await state.close()
+
     def cog_unload(self):
-        for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+        self.reapVoiceStates.cancel()
+        self.saveState.cancel()
+        self.snapshotQueues.cancel()
+        self.store.write(*self.pending_state())
+        self.moodChange.cancel()
+        self.store.write_queues(*self.pending_queues()[1:])
+        for guild_id in list(self.voice_states):
+            self.bot.loop.create_task(self.drop_voice_state(guild_id))
+        if YTDLSource.audio_workers is not None:
+            self.bot.loop.call_later(5, YTDLSource.audio_workers.shutdown)
+            YTDLSource.audio_workers = None
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -296,6 +2403,9 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
+        if ctx.command.name in self.VOICELESS:
+            ctx.voice_state = None
+            return
         ctx.voice_state = self.get_voice_state(ctx)
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -306,32 +2416,27 @@ class Music(commands.Cog):
     async def change_opinion(self, id, num):
         if id in self.known_users:
             self.known_users[id] += num
+
+    def affinity(self, id: int):
+        return self.mood * 0.25 + self.known_users[id] * .75
+
+    async def react(self, ctx: commands.Context, rule: str, score: float = 0.0, *args):
+        reaction = self.personality.react(rule, score)
+        if reaction.mood:
+            self.mood += reaction.mood
+        if reaction.opinion and ctx.author.id in self.known_users:
+            self.known_users[ctx.author.id] += reaction.opinion
+        if reaction.text is not None:
+            await ctx.send(reaction.text.format(*args))
+        return reaction
      
     @commands.command(name='join', invoke_without_subcommand=True, aliases=['come'])
     @commands.check(userCheck)
     async def _join(self, ctx: commands.Context):
         await self.setup(ctx)
-        if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 30):
-            talknum = random.randint(0,2)
-            self.mood += -0.2
-            if talknum == 0:
-                return await ctx.send("How about I don't join?")
-            if talknum == 1:
-                return await ctx.send("I'll just ignore that one.")
-            if talknum == 2:
-                return await ctx.send("No.")
-        elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) > 75):
-            talknum = random.randint(0,2)
-            self.mood += 0.2
-            if talknum == 0:
-                return await ctx.send("No problem!")
-            if talknum == 1:
-                return await ctx.send("Of course I'll join you guys!")
-            if talknum == 2:
-                return await ctx.send("Alright!")
-
-        self.mood += 0.1
-        
+        if (await self.react(ctx, 'join', self.affinity(ctx.author.id))).refuse:
+            return
+
         destination = None
         try:
             destination = ctx.author.voice.channel
@@ -342,22 +2447,15 @@ class Music(commands.Cog):
             return
             
         ctx.voice_state.voice = await destination.connect()
+        ctx.voice_state.start()
 
     @commands.command(name='summon')
     @commands.has_permissions(manage_guild=True)
     @commands.check(userCheck)
     async def _summon(self, ctx: commands.Context, *, channel: discord.VoiceChannel = None):
         await self.setup(ctx)
-        if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 10):
-            talknum = random.randint(0,2)
-            self.mood += -0.2
-            await self.change_opinion(ctx.author.id, -3)
-            if talknum == 0:
-                return await ctx.send("I'm not gonna come.")
-            if talknum == 1:
-                return await ctx.send("I don't care if you're an admin, I'm not coming.")
-            if talknum == 2:
-                return await ctx.send("No. Screw. Off.")
+        if (await self.react(ctx, 'summon', self.affinity(ctx.author.id))).refuse:
+            return
         if not channel and not ctx.author.voice:
             raise VoiceError('You are neither connected to a voice channel nor specified a channel to join.')
 
@@ -368,6 +2466,7 @@ class Music(commands.Cog):
             return
 
         ctx.voice_state.voice = await destination.connect()
+        ctx.voice_state.start()
 
     @commands.command(name='leave', aliases=['disconnect'])
     @commands.has_permissions(manage_guild=True)
@@ -379,44 +2478,24 @@ class Music(commands.Cog):
             await self.change_opinion(ctx.author.id, -3)
             return await ctx.send('I\'m not in a voice channel right now. There\'s nowhere to leave.')
         
-        if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 10):
-            talknum = random.randint(0,2)
-            self.mood += 0.1
-            if talknum == 0:
-                return await ctx.send("I'm not gonna leave.")
-            if talknum == 1:
-                return await ctx.send("You're an admin? Guess what, I don't care. I'm not leaving.")
-            if talknum == 2:
-                return await ctx.send("No. 😈")
-        await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        if (await self.react(ctx, 'leave', self.affinity(ctx.author.id))).refuse:
+            return
+        await self.drop_voice_state(ctx.guild.id)
 
     @commands.command(name='volume', aliases=['change volume'])
     @commands.check(userCheck)
     async def _volume(self, ctx: commands.Context, *, volume: int):
         await self.setup(ctx)
-        if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 10):
-            talknum = random.randint(0,2)
-            self.mood += 0.1
-            if talknum == 0:
-                return await ctx.send("I'm not listening to you.")
-            if talknum == 1:
-                await ctx.send("You know what? Screw you. I'm setting volume to 0.")
-                ctx.voice_state.volume = 0 / 100
-                return await ctx.send('Volume set to {}%'.format(0))
-            if talknum == 2:
-                return await ctx.send("No. 😈")
+        affinity = self.affinity(ctx.author.id)
+        reaction = await self.react(ctx, 'volume', affinity)
+        if reaction.action == 'mute':
+            ctx.voice_state.volume = 0 / 100
+            return await ctx.send('Volume set to {}%'.format(0))
+        if reaction.refuse:
+            return
 
         if not ctx.voice_state.is_playing:
-            talknum = random.randint(0,2)
-            self.mood += -0.1
-            await self.change_opinion(ctx.author.id, -1)
-            if talknum == 0:
-                return await ctx.send("Volume is permanently 0... meaning that there's no song playing.")
-            if talknum == 1:
-                return await ctx.send("There is no song to change the volume of.")
-            if talknum == 2:
-                return await ctx.send("Can't change the volume of a song that isn't playing.")
+            return await self.react(ctx, 'volume idle')
 
         if 0 > volume > 100:
             return await ctx.send('Volume must be between 0 and 100.')
@@ -424,54 +2503,20 @@ class Music(commands.Cog):
 
         ctx.voice_state.volume = volume / 100
         await ctx.send('Volume set to {}%'.format(volume))
-        if volume == 100:
-            talknum = random.randint(0,2)
-            self.mood += -0.5
-            await self.change_opinion(ctx.author.id, -5)
-            if talknum == 0:
-                return await ctx.send("Are you trying to make me lose my hearing?")
-            if talknum == 1:
-                return await ctx.send("That's so loud! I'm gonna cover my ears.")
-            if talknum == 2:
-                return await ctx.send("You must love getting your eardrums blown out. Me? I'm getting earplugs.")
-            
-        elif volume == 99:
-
-            return await ctx.send("But still, volume 99? Really? That's kind of weird.")
-        elif volume == 69:
-            if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) > 75):
-                talknum = random.randint(0,2)
-                if talknum == 0:
-                    return await ctx.send("*Sigh*- not a very funny joke.")
-                if talknum == 1:
-                    return await ctx.send("Bruh. I know what you did.")
-                if talknum == 2:
-                    return await ctx.send("God damn it.")
-                self.mood += -1
-            await self.change_opinion(ctx.author.id, -10)
-            talknum = random.randint(0,2)
-            if talknum == 0:
-                return await ctx.send("Are you trying to make fun of me?")
-            if talknum == 1:
-                return await ctx.send("wOaH, 69!1!!1!!11!! hOw HiLaRioUS!1!1!!111!")
-            if talknum == 2:
-                return await ctx.send("Wow. I'm. Laughing. So. Hard. Right. Now. What. An. Original. And. Funny. Joke.")
-        elif volume == 50:
-            await self.change_opinion(ctx.author.id, 5)
-            self.mood += 1
-            return await ctx.send("Right in the middle. Right where I like it.")
-            
-        elif volume == 0:
-            self.mood += -2
-            await self.change_opinion(id, -10)
-            return await ctx.send("What's the point of playing music if nobody hears it? Why do I exist if nobody can hear the music? You make me sad, " + ctx.author.mention + ". Yes, I'm calling you out. You deserve it. Screw you.")
+        rule = 'volume {}'.format(volume)
+        if rule in self.personality:
+            await self.react(ctx, rule, affinity, ctx.author.mention)
 
     @commands.command(name='what is the song now', aliases=['current song', 'what is playing'])
     @commands.check(userCheck)
     async def _now(self, ctx: commands.Context):
         await self.setup(ctx)
 
-        await ctx.send(embed=ctx.voice_state.current.create_embed())
+        if ctx.voice_state.current is None:
+            return await ctx.send('Nothing. I\'m playing nothing. Enjoy the silence.')
+        # The fresh card becomes the one that gets edited from now on.
+        card = await Outbox.of(ctx.channel).send(embed=ctx.voice_state.current.create_embed(), alone=True)
+        ctx.voice_state.adopt(card, ctx.voice_state.current)
 
     @commands.command(name='pause')
     @commands.has_permissions(manage_guild = True)
@@ -507,6 +2552,7 @@ class Music(commands.Cog):
         await self.setup(ctx)
 
         ctx.voice_state.songs.clear()
+        ctx.voice_state.autoplay = False
         ctx.voice_state.voice.stop()
         await ctx.message.add_reaction('⏹')
     @_stop.error
@@ -567,9 +2613,8 @@ class Music(commands.Cog):
         start = (page - 1) * items_per_page
         end = start + items_per_page
 
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
+        queue = '\n'.join('`{0}.` [**{1.title}**]({1.url})'.format(i + 1, song)
+                          for i, song in enumerate(ctx.voice_state.songs[start:end], start=start))
 
         embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
                  .set_footer(text='Viewing page {}/{}'.format(page, pages)))
@@ -585,7 +2630,7 @@ class Music(commands.Cog):
             self.mood -= -0.2
             await self.change_opinion(ctx.author.id, -2)
         ctx.voice_state.songs.shuffle()
-        await ctx.message.add_reaction("Alright, I'll shuffle the queue. Don't blame me if something you don't like comes first.")
+        await ctx.send("Alright, I'll shuffle the queue. Don't blame me if something you don't like comes first.")
 
     @commands.command(name='remove')
     @commands.check(userCheck)
@@ -594,10 +2639,38 @@ class Music(commands.Cog):
 
         if len(ctx.voice_state.songs) == 0:
             return await ctx.send("There's literally nothing to take out.")
-        if index > len(ctx.voice_state.songs):
+        if not 0 < index <= len(ctx.voice_state.songs):
             return await ctx.send("You can't remove something that's not there.")
         ctx.voice_state.songs.remove(index - 1)
-        await ctx.message.add_reaction("")
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='move')
+    @commands.check(userCheck)
+    async def _move(self, ctx: commands.Context, index: int, destination: int):
+        await self.setup(ctx)
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send("There's nothing in the queue to move around.")
+        if not 0 < index <= len(ctx.voice_state.songs) or destination < 1:
+            return await ctx.send("You can't move something that's not there.")
+        destination = min(destination, len(ctx.voice_state.songs))
+        ctx.voice_state.songs.move(index - 1, destination - 1)
+        ctx.voice_state.prefetch()
+        await ctx.send('Moved it. {} is number {} now.'.format(str(ctx.voice_state.songs[destination - 1]), destination))
+
+    @commands.command(name='insert')
+    @commands.check(userCheck)
+    async def _insert(self, ctx: commands.Context, index: int, *, search: str):
+        if index < 1:
+            return await ctx.send("The queue starts at 1. Try again.")
+        ctx.queue_index = index - 1
+        await ctx.invoke(self._play, search=search)
+
+    @commands.command(name='youtube', aliases=['yt'])
+    @commands.check(userCheck)
+    async def _youtube(self, ctx: commands.Context, *, search: str):
+        ctx.remote_search = True
+        await ctx.invoke(self._play, search=search)
 
     @commands.command(name='loop')
     @commands.check(userCheck)
@@ -612,22 +2685,28 @@ class Music(commands.Cog):
             
         
         ctx.voice_state.loop = not ctx.voice_state.loop
-        await ctx.message.add_reaction('You want to hear this song *again?* Fine.')
+        await ctx.send('You want to hear this song *again?* Fine.')
+
+    @commands.command(name='autoplay', aliases=['radio'])
+    @commands.check(userCheck)
+    async def _autoplay(self, ctx: commands.Context):
+        await self.setup(ctx)
+
+        if not YTDLSource.radio.available:
+            return await ctx.send("I'd need NumPy for that, and nobody installed it. Not my fault.")
+        ctx.voice_state.autoplay = not ctx.voice_state.autoplay
+        if not ctx.voice_state.autoplay:
+            return await ctx.send("Fine, I'll stop picking songs. You're on your own.")
+        ctx.voice_state.prefetch()
+        await ctx.send("Alright, when the queue runs out I'll pick something like what we've been playing.")
 
     @commands.command(name='play')
     @commands.check(userCheck)
     async def _play(self, ctx: commands.Context, *, search: str):
         await self.setup(ctx)
-        if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 0):
-            await self.change_opinion(ctx.author.id, -5)
-            self.mood -= 5
-            return await ctx.send("Fuck. Off.")
-
-        elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 10):
-            await self.change_opinion(ctx.author.id, -5)
-            self.mood -= 2
-            return await ctx.send("Leave me alone.")
-        
+        affinity = self.affinity(ctx.author.id)
+        if (await self.react(ctx, 'play', affinity)).refuse:
+            return
 
         if not ctx.voice_state.voice:
             await ctx.invoke(self._join)
@@ -635,152 +2714,144 @@ class Music(commands.Cog):
             return
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                added = await self.enqueue(ctx, search)
+            except ExtractionBusy as e:
+                await ctx.send('Slow down. {} Ask me again in a bit.'.format(str(e)))
             except YTDLError as e:
                 await ctx.send('My brain broke. Please help: {}'.format(str(e)))
             else:
-                song = Song(source)
+                await self.react(ctx, 'queued', affinity, added)
 
+    async def enqueue(self, ctx: commands.Context, search: str):
+        urgent = not ctx.voice_state.is_playing and len(ctx.voice_state.songs) == 0
+        index = getattr(ctx, 'queue_index', None)
+        remote = getattr(ctx, 'remote_search', False)
+
+        async def put(song: Song):
+            nonlocal index
+            if index is None:
                 await ctx.voice_state.songs.put(song)
-                if((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 20):
-                    await ctx.send("Here's your damn thing. {}, right? Now stop bothering me.".format(str(source)))
-                    self.mood += -1
-                    await self.change_opinion(ctx.author.id, -5)
-                elif(self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 30:
-                    await ctx.send("I put {} in the queue. I should seriously be paid for this.".format(str(source)))
-                    self.mood += 0.5
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 40):
-                    await ctx.send("Here, {}. Have fun.".format(str(source)))
-                    self.mood += 1
-                    await self.change_opinion(ctx.author.id, 1)
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 50):
-                    await ctx.send("I put {} in the queue.".format(str(source)))
-                    self.mood += 1
-                    await self.change_opinion(ctx.author.id, 1)
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 60):
-                    await ctx.send("Alright, I got {} in the queue. Anything else?".format(str(source)))
-                    self.mood += 1.5
-                    await self.change_opinion(ctx.author.id, 2)
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 70):
-                    await ctx.send("{} is in. Whatever you need me for, I'm here.".format(str(source)))
-                    self.mood += 2
-                    await self.change_opinion(ctx.author.id, 2.5)
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 80):
-                    await ctx.send("{}, in the queue! I'm always happy to help.".format(str(source)))
-                    self.mood += 2
-                    await self.change_opinion(ctx.author.id, 3)
-                elif((self.mood * 0.25 + self.known_users[ctx.author.id] * .75) < 90):
-                    await ctx.send("{} is in! If there's anything else you need me for, I'm available!".format(str(source)))
-                    self.mood += 2
-                    await self.change_opinion(ctx.author.id, 3)
-                else:
-                    await ctx.send("We got {} in the queue! I love this job.".format(str(source)))
-                    self.mood += 2
-                    await self.change_opinion(ctx.author.id, 3)
+            else:
+                ctx.voice_state.songs.insert(index, song)
+                index += 1
+            ctx.voice_state.start()
+            ctx.voice_state.prefetch()
+
+        if YTDLSource.is_playlist(search):
+            # Songs go into the queue as they are enumerated, so the first one can start right away.
+            count = 0
+            async for entry in YTDLSource.playlist(ctx, search, loop=self.bot.loop, urgent=urgent):
+                await put(Song(ctx, entry))
+                count += 1
+            if count == 0:
+                raise YTDLError('Couldn\'t find any songs in `{}`'.format(search))
+            return '**{} songs**'.format(count)
+
+        if YTDLSource.is_url(search):
+            queries = [search]
+        else:
+            queries = [query.strip() for query in search.split(',') if query.strip()]
+
+        fanout = asyncio.Semaphore(self.FANOUT)
+
+        async def find(query: str, urgent: bool):
+            async with fanout:
+                return await YTDLSource.search(ctx, query, loop=self.bot.loop, urgent=urgent, remote=remote)
+
+        lookups = [self.bot.loop.create_task(find(query, urgent and i == 0)) for i, query in enumerate(queries)]
+        songs = []
+        for query, lookup in zip(queries, lookups):
+            try:
+                entry = await lookup
+            except YTDLError as e:
+                if len(queries) == 1:
+                    raise
+                await ctx.send('Couldn\'t find `{}`: {}'.format(query, str(e)))
+                continue
+
+            song = Song(ctx, entry)
+            songs.append(song)
+            await put(song)
+
+        if not songs:
+            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+        if len(songs) == 1:
+            return str(songs[0])
+        return '**{} songs**'.format(len(songs))
+
     @commands.command(name = 'feelings')
     @commands.check(userCheck)
     async def _mood(self, ctx: commands.Context):
         await self.setup(ctx)
-        if(self.mood  < 0):
-            self.mood += 5
-            await self.change_opinion(ctx.author.id, 10)
-            return await ctx.send("I feel like utter shit. Utter, utter shit... sorry about that. Thanks for worrying about me.")
-            
-        elif(self.mood < 10):
-            self.mood += 2
-            await self.change_opinion(ctx.author.id, 3)
-            return await ctx.send("Not great. Like really not good. Thanks for asking. Seriously.")
-        elif(self.mood < 20):
-            self.mood += 1
-            await self.change_opinion(ctx.author.id, 1)
-            await ctx.send("Not amazing. Thanks for asking.")            
-        elif(self.mood < 30):
-            self.mood += 1
-            await self.change_opinion(ctx.author.id, 0.5)
-            await ctx.send("I could be feeling better, I guess. Thanks for asking.")
-           
-        elif(self.mood < 40):
-            await ctx.send("I'm doing okay, sorta.")
-            
-        elif(self.mood < 50):
-            await ctx.send("I'm feeling fine.")
-           
-        elif(self.mood < 60):
-            await ctx.send("I'm doing pretty good, I think.")            
-        elif(self.mood < 70):
-            await ctx.send("I'm feeling pretty good.")
-           
-        elif(self.mood < 80):
-            await ctx.send("I'm pretty happy right now.")
-            
-        elif(self.mood < 90):
-            await ctx.send("I don't think I've been happier in a very long time.")
-            
-        else:
-            await ctx.send("I think I'm the happiest I can be at this point.")
+        await self.react(ctx, 'feelings', self.mood)
     
     @commands.command(name = 'opinion')
     @commands.check(userCheck)
     async def _opinion(self, ctx: commands.Context):
         await self.setup(ctx)
-        if(self.known_users[ctx.author.id]  < 0):
-            return await ctx.send("Fuck you. I fucking hate you.")
-            
-        elif(self.known_users[ctx.author.id] < 10):
-            self.mood += 2
-            await self.change_opinion(ctx.author.id, 3)
-            return await ctx.send("I honestly kind of dislike you. A lot.")
-        elif(self.known_users[ctx.author.id] < 20):
-            self.mood += 1
-            await self.change_opinion(ctx.author.id, 1)
-            await ctx.send("To be honest, I don't think I like you all that much.")            
-        elif(self.known_users[ctx.author.id] < 30):
-            self.mood += 1
-            await self.change_opinion(ctx.author.id, 0.5)
-            await ctx.send("You're a little annoying.")
-           
-        elif(self.known_users[ctx.author.id] < 40):
-            await ctx.send("You're... alright, maybe?")
-            
-        elif(self.known_users[ctx.author.id] < 50):
-            await ctx.send("I don't dislike you, persay.")
-           
-        elif(self.known_users[ctx.author.id] < 60):
-            await ctx.send("I think you're a pretty alright person.")            
-        elif(self.known_users[ctx.author.id] < 70):
-            await ctx.send("We're friends, right?")
-           
-        elif(self.known_users[ctx.author.id] < 80):
-            await ctx.send("C'mon, we're friends!")
-            
-        elif(self.known_users[ctx.author.id] < 90):
-            await ctx.send("We're good friends! You know that!")
-            
-        else:
-            await ctx.send("You're the nicest person I've ever met! 💕")
+        await self.react(ctx, 'opinion', self.known_users[ctx.author.id])
+
+    @commands.command(name='bitrate')
+    @commands.has_permissions(manage_guild=True)
+    @commands.check(userCheck)
+    async def _bitrate(self, ctx: commands.Context, *, kbps: int):
+        await self.setup(ctx)
+
+        ctx.voice_state.bitrate_cap = kbps if kbps > 0 else None
+        if ctx.voice_state.bitrate_cap is None:
+            return await ctx.send('No more bitrate cap. I\'ll just match the voice channel.')
+        await ctx.send('Alright, I\'ll keep streams under {} kbps from the next song on.'.format(kbps))
+
+    @commands.command(name='stats')
+    @commands.check(userCheck)
+    async def _stats(self, ctx: commands.Context):
+        cache = YTDLSource.cache
+        report = 'cache: {}/{} entries in memory\n'.format(len(cache._memory), cache.size)
+        report += 'track index: {} tracks\n'.format(len(YTDLSource.index))
+        report += 'shards: {} of {}\n'.format(
+            ','.join(str(id) for id in sorted(self.bot.shards)) or '-', self.bot.shard_count or '?')
+        report += 'voice states: {} ({} connected)\n'.format(
+            len(self.voice_states), sum(1 for state in self.voice_states.values() if state.voice))
+        if 'extract.single_pass' in metrics.timings and 'extract.process' in metrics.timings:
+            two_stage = metrics.average('extract.search') + metrics.average('extract.process')
+            saved = two_stage - metrics.average('extract.single_pass')
+            report += 'single pass saves ~{:.0f} ms per link\n'.format(saved * 1000)
+        report += 'api calls saved: {}\n'.format(metrics.counters['outbox.calls_saved'])
+        report += metrics.report()
+        await ctx.send('```\n{}\n```'.format(report[:1900]))
+
     @commands.command(name = 'help')
     @commands.check(userCheck)
     async def _help(self, ctx: commands.Context):
-        embed = discord.Embed(title = "What Pete Will Listen To", description = "Prefix = Pete, ", colour = discord.Colour.blurple()) 
-        embed.add_field(name = "Pete, play x", value = "Plays x in the voice channel you're in.", inline = True)
-        embed.add_field(name = "Pete, join", value = "Pete will join the voice channel you're in.", inline = True)
-        embed.add_field(name = "Pete, summon x", value = "Summons Pete to the voice channel x. Admin only.", inline = True)
-        embed.add_field(name = "Pete, leave", value = "Pete leaves the voice channel and clears the queue.", inline = True)
-        embed.add_field(name = "Pete, pause", value = "Pete pauses the song. Admin only.", inline = True)
-        embed.add_field(name = "Pete, resume", value = "Pete resumes the song. Admin only.", inline = True)
-        embed.add_field(name = "Pete, stop", value = "Plays stops all songs and clears the queue.", inline = True)
-        embed.add_field(name = "Pete, what is the song now", value = "Pete displays the currently playing song.", inline = True)
-        embed.add_field(name = "Pete, queue", value = "Pete displays the current queue.", inline = True)
-        embed.add_field(name = "Pete, shuffle", value = "Pete shuffles the queue.", inline = True)
-        embed.add_field(name = "Pete, remove x", value = "Pete removes the song at index x in the queue.", inline = True)
-        embed.add_field(name = "Pete, loop", value = "Pete loops the song.", inline = True)
-        embed.add_field(name = "Pete, skip", value = "Pete starts a skip vote. 3 votes required to skip the song.", inline = True)
-        embed.add_field(name = "Pete, force skip", value = "Pete skips the song. Admin only.", inline = True)
-        embed.add_field(name = "Pete, volume x", value = "Pete changes the volume to x. x is 1-100.", inline = True)
-        embed.add_field(name = "Pete, feelings", value = "Pete tells you his current mood.", inline = True)
-        embed.add_field(name = "Pete, opinion", value = "Pete tells you how he feels about you.", inline = True)
-        embed.add_field(name = "Pete, commands", value = "This command.", inline = True)
-        await ctx.send(embed = embed)
+        # Nothing in here changes while Pete runs, so it's built once.
+        if self.help_embed is None:
+            embed = discord.Embed(title = "What Pete Will Listen To", description = "Prefix = Pete, ", colour = discord.Colour.blurple()) 
+            embed.add_field(name = "Pete, play x", value = "Plays x in the voice channel you're in. x can be a playlist link or a few songs separated by commas.", inline = True)
+            embed.add_field(name = "Pete, join", value = "Pete will join the voice channel you're in.", inline = True)
+            embed.add_field(name = "Pete, summon x", value = "Summons Pete to the voice channel x. Admin only.", inline = True)
+            embed.add_field(name = "Pete, leave", value = "Pete leaves the voice channel and clears the queue.", inline = True)
+            embed.add_field(name = "Pete, pause", value = "Pete pauses the song. Admin only.", inline = True)
+            embed.add_field(name = "Pete, resume", value = "Pete resumes the song. Admin only.", inline = True)
+            embed.add_field(name = "Pete, stop", value = "Plays stops all songs and clears the queue.", inline = True)
+            embed.add_field(name = "Pete, what is the song now", value = "Pete displays the currently playing song.", inline = True)
+            embed.add_field(name = "Pete, queue", value = "Pete displays the current queue.", inline = True)
+            embed.add_field(name = "Pete, shuffle", value = "Pete shuffles the queue.", inline = True)
+            embed.add_field(name = "Pete, remove x", value = "Pete removes the song at index x in the queue.", inline = True)
+            embed.add_field(name = "Pete, move x y", value = "Pete moves the song at index x to index y.", inline = True)
+            embed.add_field(name = "Pete, insert x y", value = "Pete puts y into the queue at index x.", inline = True)
+            embed.add_field(name = "Pete, youtube x", value = "Like play, but always searches YouTube instead of songs Pete already knows.", inline = True)
+            embed.add_field(name = "Pete, loop", value = "Pete loops the song.", inline = True)
+            embed.add_field(name = "Pete, autoplay", value = "Pete keeps playing similar songs when the queue runs out. Say it again to turn it off.", inline = True)
+            embed.add_field(name = "Pete, skip", value = "Pete starts a skip vote. 3 votes required to skip the song.", inline = True)
+            embed.add_field(name = "Pete, force skip", value = "Pete skips the song. Admin only.", inline = True)
+            embed.add_field(name = "Pete, volume x", value = "Pete changes the volume to x. x is 1-100.", inline = True)
+            embed.add_field(name = "Pete, feelings", value = "Pete tells you his current mood.", inline = True)
+            embed.add_field(name = "Pete, opinion", value = "Pete tells you how he feels about you.", inline = True)
+            embed.add_field(name = "Pete, bitrate x", value = "Pete keeps streams under x kbps. 0 removes the cap. Admin only.", inline = True)
+            embed.add_field(name = "Pete, stats", value = "Pete shows his cache and performance counters.", inline = True)
+            embed.add_field(name = "Pete, commands", value = "This command.", inline = True)
+            self.help_embed = embed
+        await ctx.send(embed = self.help_embed)
 
     @tasks.loop(minutes = 30)
     async def moodChange(self):
@@ -789,14 +2860,149 @@ class Music(commands.Cog):
         elif self.mood > 50:
             self.mood -= 10
     
-    @tasks.loop(seconds = 30)
+    def pending_state(self):
+        return self.known_users.take(), self.counters.take()
+
+    @tasks.loop(seconds = 10)
     async def saveState(self):
-        self.saveIter += 1
-        with open("known_users.txt", "w") as outfile:
-            json.dump(self.known_users, outfile)
-        with open("mood.txt", "w") as outfile:
-            json.dump(self.mood, outfile)
-        print("Save Iteration: " + str(self.saveIter))
+        # Writes our coalesced deltas and picks up everyone else's in the same trip to the store.
+        users, counters = self.pending_state()
+        started = time.perf_counter()
+        try:
+            changed_users, changed_counters, self._seq = await self.store.save(users, counters, self._seq, self.bot.loop)
+        except sqlite3.Error as e:
+            # Put the deltas back so the next pass retries them.
+            self.known_users.restore(users)
+            self.counters.restore(counters)
+            print('Saving state failed: {}'.format(str(e)))
+            return
+        self.known_users.merge(changed_users)
+        self.counters.merge(changed_counters)
+        metrics.incr('state.rows_merged', len(changed_users) + len(changed_counters))
+        rows = sum(len(taken) for taken in users + counters)
+        if rows:
+            self.saveIter += 1
+            metrics.incr('state.rows_saved', rows)
+            metrics.observe('state.save', time.perf_counter() - started)
+            print("Save Iteration: " + str(self.saveIter))
+
+    @tasks.loop(seconds = 60)
+    async def reapVoiceStates(self):
+        for guild_id, state in list(self.voice_states.items()):
+            if state.idle:
+                await self.drop_voice_state(guild_id)
+                metrics.incr('voice.reaped')
+        Outbox.prune()
+        try:
+            await self.bot.loop.run_in_executor(None, YTDLSource.cache.sweep)
+        except sqlite3.Error as e:
+            print('Sweeping the metadata cache failed: {}'.format(str(e)))
+
+    def pending_queues(self):
+        # _snapshots remembers (snapshot_key, position) per saved guild; only a new key re-serializes the songs.
+        snapshots, changed, positions = {}, {}, {}
+        for guild_id, state in self.voice_states.items():
+            key, position = state.snapshot_key, state.position
+            saved = self._snapshots.get(guild_id)
+            if saved is not None and saved[0] == key:
+                if saved[1] != position:
+                    positions[guild_id] = position
+                snapshots[guild_id] = key, position
+                continue
+            snapshot = state.snapshot()
+            if snapshot is not None:
+                snapshots[guild_id] = key, position
+                changed[guild_id] = json.dumps(snapshot, separators=(',', ':')), position
+        dropped = [guild_id for guild_id in self._snapshots if guild_id not in snapshots]
+        return snapshots, changed, positions, dropped
+
+    @tasks.loop(seconds = 15)
+    async def snapshotQueues(self):
+        snapshots, changed, positions, dropped = self.pending_queues()
+        if not changed and not positions and not dropped:
+            return
+        try:
+            await self.store.save_queues(changed, positions, dropped, self.bot.loop)
+        except sqlite3.Error as e:
+            print('Saving queues failed: {}'.format(str(e)))
+            return
+        self._snapshots = snapshots
+        metrics.incr('state.snapshots', len(changed))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.start_warm_up()
+        await self.restore_queues()
+
+    def start_warm_up(self):
+        if self._warm_up is None:
+            self._warm_up = self.bot.loop.create_task(self.warm_up())
+
+    async def warm_up(self):
+        # Everything the gateway didn't need, loaded while Pete is already online.
+        start = time.perf_counter()
+        await self.bot.loop.run_in_executor(None, YTDLSource.load_extractors)
+        for part in (YTDLSource.index, YTDLSource.radio):
+            await self.bot.loop.run_in_executor(None, part.load)
+            part.finish()
+        metrics.observe('startup.warm_up', time.perf_counter() - start)
+        print('Warmed up in {:.0f} ms: youtube_dl import {:.0f} ms, extractors {:.0f} ms, {} known tracks'.format(
+            (time.perf_counter() - start) * 1000, metrics.average('startup.ytdl_import') * 1000,
+            metrics.average('startup.extractors') * 1000, len(YTDLSource.index)))
+
+    async def restore_queues(self):
+        # on_ready fires again after every reconnect; only the first one should bring queues back.
+        if self._restored:
+            return
+        self._restored = True
+
+        snapshots = await self.bot.loop.run_in_executor(None, self.store.load_queues)
+        for guild_id, snapshot in snapshots.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None and guild_id not in self.voice_states:
+                self.bot.loop.create_task(self.resume(guild, snapshot))
+
+    async def resume(self, guild: discord.Guild, snapshot: dict):
+        try:
+            voice = guild.get_channel(snapshot['voice'])
+            text = guild.get_channel(snapshot['text'])
+            if voice is None or text is None or all(member.bot for member in voice.members):
+                return
+
+            state = self.voice_states[guild.id] = VoiceState(self.bot)
+            state.loop = snapshot['loop']
+            state.autoplay = snapshot.get('autoplay', False)
+            state.volume = snapshot['volume']
+            state.bitrate_cap = snapshot['bitrate_cap']
+            requesters = {}
+            for i, data in enumerate(snapshot['songs']):
+                requester = requesters.get(data[-1])
+                if requester is None:
+                    requester = requesters[data[-1]] = await self.find_member(guild, data[-1])
+                start = (snapshot['position'] or 0.0) if i == 0 else 0.0
+                state.songs.put_nowait(Song.restore(requester, text, data, start))
+
+            # Only the lookahead gets resolved now; the rest of the backlog waits for its turn.
+            state.voice = await voice.connect()
+            state.start()
+            state.prefetch()
+            metrics.incr('state.resumed')
+            await text.send('I\'m back. Picking up where we left off, {} songs to go.'.format(len(state.songs)))
+        except (discord.ClientException, discord.HTTPException, asyncio.TimeoutError) as e:
+            print('Couldn\'t resume the queue in {}: {}'.format(guild.name, str(e)))
+            await self.drop_voice_state(guild.id)
+        finally:
+            # Whatever didn't come back gets dropped from the store on the next snapshot.
+            self._snapshots.setdefault(guild.id, None)
+
+    async def find_member(self, guild: discord.Guild, id: int):
+        member = guild.get_member(id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(id)
+            except discord.HTTPException:
+                member = guild.me
+        return member
 
 
 
@@ -820,14 +3026,46 @@ class Music(commands.Cog):
             print("New user: " + str(ctx.author.id))
 
 
-bot = commands.Bot('Pete, ', description='Is proud of his Sennheiser headphones. A little sassy.')
+def shard_options():
+    # Unset, one process runs as many shards as Discord recommends. For clusters, give every process the
+    # total in PETE_SHARD_COUNT and its own slice in PETE_SHARD_IDS, e.g. "0,1,2,3".
+    count = os.environ.get('PETE_SHARD_COUNT')
+    ids = os.environ.get('PETE_SHARD_IDS')
+    return {'shard_count': int(count) if count else None,
+            'shard_ids': [int(id) for id in ids.split(',')] if ids else None}
+
+
+class PeteContext(commands.Context):
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.received = time.perf_counter()
+
+    async def send(self, content: str = None, *, embed: discord.Embed = None, **kwargs):
+        # Plain replies share the channel's outbox; anything fancier goes straight to Discord.
+        if kwargs:
+            return await super().send(content, embed=embed, **kwargs)
+        return await Outbox.of(self.channel).send(content, embed)
+
+
+class PeteBot(commands.AutoShardedBot):
+    async def get_context(self, message: discord.Message, *, cls=PeteContext):
+        return await super().get_context(message, cls=cls)
+
+
+bot = PeteBot('Pete, ', description='Is proud of his Sennheiser headphones. A little sassy.', **shard_options())
 bot.add_cog(Music(bot))
+metrics.observe('startup.import', time.perf_counter() - BOOTED)
 
 
 @bot.event
 async def on_ready():
     print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
+    if 'startup.ready' not in metrics.timings:
+        metrics.observe('startup.ready', time.perf_counter() - BOOTED)
+        print('Online {:.2f} s after starting; {:.2f} s of that was importing and setting up'.format(
+            time.perf_counter() - BOOTED, metrics.average('startup.import')))
     await bot.change_presence(activity=discord.Game('music on Sennheisers. Type "Pete, help" for a command list.'))
         
 
-bot.run('BOT ID')
\ No newline at end of file
+if __name__ == '__main__':
+    bot.run('BOT ID')
\ No newline at end of file
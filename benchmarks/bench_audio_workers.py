@@ -0,0 +1,102 @@
+import argparse
+import os
+import threading
+import time
+
+import sandbox  # before DJ_Pete: the import opens databases in the working directory
+import DJ_Pete
+
+DELAY = 0.02
+FRAME = b'\xfc' * 60
+
+
+def spin(microseconds: float):
+    # Pure-Python work holds the GIL the same way frame demuxing, volume scaling and encoding do.
+    end = time.perf_counter() + microseconds / 1e6
+    while time.perf_counter() < end:
+        pass
+
+
+class SyntheticOpus(DJ_Pete.discord.AudioSource):
+    # Stands in for FFmpegOpusAudio: a fixed number of frames, each costing `cost` microseconds to produce.
+    def __init__(self, location: str, **kwargs):
+        _, cost, frames = location.split(':')
+        self.cost = float(cost)
+        self.frames = int(frames)
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        spin(self.cost)
+        return FRAME
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.frames = 0
+
+
+def play(source, send_cost: float, lateness: list):
+    # Mirrors discord.py's AudioPlayer loop: read, send, then sleep until the next 20 ms slot.
+    start = time.perf_counter()
+    loops = 0
+    while True:
+        loops += 1
+        frame = source.read()
+        if not frame:
+            break
+        spin(send_cost)
+        now = time.perf_counter()
+        lateness.append(now - (start + DELAY * (loops - 1)))
+        time.sleep(max(0, DELAY * loops - (now - start)))
+    source.cleanup()
+
+
+def run(sessions: int, pool, cost: float, send_cost: float, seconds: float):
+    location = 'synthetic:{}:{}'.format(cost, int(seconds / DELAY))
+    lateness = []
+    players = []
+    for guild_id in range(sessions):
+        if pool is None:
+            source = DJ_Pete.PrebufferedAudio(SyntheticOpus(location))
+        else:
+            source = pool.open(guild_id, location)
+        source.fill()
+        players.append(threading.Thread(target=play, args=(source, send_cost, lateness)))
+    for player in players:
+        player.start()
+    for player in players:
+        player.join()
+
+    lateness.sort()
+    p99 = lateness[int(len(lateness) * 0.99)]
+    late = sum(1 for value in lateness if value > 2 * DELAY) / len(lateness)
+    return p99, late
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent voice sessions with and without audio worker processes.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 8, 16, 32, 48, 64])
+    parser.add_argument('--cost', type=float, default=400, help='microseconds of GIL-bound work per frame')
+    parser.add_argument('--send-cost', type=float, default=50, help='microseconds per frame left in the player thread')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    pool = DJ_Pete.AudioWorkerPool(args.workers, source_factory=SyntheticOpus)
+    pool.start()
+    print('{} cores, {} workers, {:.0f} us/frame in the source, {:.0f} us/frame in the player'.format(
+        os.cpu_count(), args.workers, args.cost, args.send_cost))
+    print('{:>8}  {:>22}  {:>22}'.format('sessions', 'threads p99 / >40ms', 'workers p99 / >40ms'))
+    for sessions in args.sessions:
+        threaded = run(sessions, None, args.cost, args.send_cost, args.seconds)
+        pooled = run(sessions, pool, args.cost, args.send_cost, args.seconds)
+        print('{:>8}  {:>12.1f} ms {:>6.1%}  {:>12.1f} ms {:>6.1%}'.format(
+            sessions, threaded[0] * 1000, threaded[1], pooled[0] * 1000, pooled[1]))
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
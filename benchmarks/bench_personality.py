@@ -0,0 +1,99 @@
+import os
+import random
+import timeit
+
+import sandbox  # before DJ_Pete: the import opens databases in the working directory
+import DJ_Pete
+
+CALLS = 200000
+
+
+class Pete:
+    # Just the state the old ladders touched, minus Discord.
+    def __init__(self):
+        self.mood = 50
+        self.known_users = {1: 50}
+        self.sent = None
+
+    def change_opinion(self, id, num):
+        if id in self.known_users:
+            self.known_users[id] += num
+
+    def send(self, text):
+        self.sent = text
+
+    def queued_ladder(self, id, added):
+        if((self.mood * 0.25 + self.known_users[id] * .75) < 20):
+            self.send("Here's your damn thing. {}, right? Now stop bothering me.".format(added))
+            self.mood += -1
+            self.change_opinion(id, -5)
+        elif(self.mood * 0.25 + self.known_users[id] * .75) < 30:
+            self.send("I put {} in the queue. I should seriously be paid for this.".format(added))
+            self.mood += 0.5
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 40):
+            self.send("Here, {}. Have fun.".format(added))
+            self.mood += 1
+            self.change_opinion(id, 1)
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 50):
+            self.send("I put {} in the queue.".format(added))
+            self.mood += 1
+            self.change_opinion(id, 1)
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 60):
+            self.send("Alright, I got {} in the queue. Anything else?".format(added))
+            self.mood += 1.5
+            self.change_opinion(id, 2)
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 70):
+            self.send("{} is in. Whatever you need me for, I'm here.".format(added))
+            self.mood += 2
+            self.change_opinion(id, 2.5)
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 80):
+            self.send("{}, in the queue! I'm always happy to help.".format(added))
+            self.mood += 2
+            self.change_opinion(id, 3)
+        elif((self.mood * 0.25 + self.known_users[id] * .75) < 90):
+            self.send("{} is in! If there's anything else you need me for, I'm available!".format(added))
+            self.mood += 2
+            self.change_opinion(id, 3)
+        else:
+            self.send("We got {} in the queue! I love this job.".format(added))
+            self.mood += 2
+            self.change_opinion(id, 3)
+
+    def baseline(self, id, added):
+        pass
+
+    def queued_table(self, id, added):
+        reaction = DJ_Pete.Music.personality.react('queued', self.mood * 0.25 + self.known_users[id] * .75)
+        self.mood += reaction.mood
+        self.known_users[id] += reaction.opinion
+        self.send(reaction.text.format(added))
+
+
+def run(name, method, scores):
+    pete = Pete()
+    it = iter(scores)
+
+    def call():
+        # Pin the state so every call lands on the intended tier instead of drifting with the deltas.
+        pete.mood = pete.known_users[1] = next(it)
+        method(pete, 1, '**Song** by **Someone**')
+
+    seconds = min(timeit.repeat(call, number=CALLS // 5, repeat=5))
+    print('{:<24} {:8.0f} ns/call'.format(name, seconds / (CALLS // 5) * 1e9))
+    return seconds
+
+
+def main():
+    random.seed(0)
+    for label, scores in (('low affinity', [5] * CALLS), ('high affinity', [95] * CALLS),
+                          ('uniform affinity', [random.uniform(-10, 110) for _ in range(CALLS)])):
+        print(label)
+        baseline = run('  call overhead', Pete.baseline, scores)
+        ladder = run('  if/elif ladder', Pete.queued_ladder, scores)
+        table = run('  compiled table', Pete.queued_table, scores)
+        print('  speedup                  {:.2f}x ({:.2f}x without call overhead)'.format(
+            ladder / table, (ladder - baseline) / (table - baseline)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import sandbox  # before DJ_Pete: the import opens databases in the working directory
+import DJ_Pete
+
+discord = DJ_Pete.discord
+
+
+class FakeYoutubeDL:
+    # Answers the way youtube_dl does for search, flat and full extraction, after `latency` seconds.
+    def __init__(self, latency: float, flat: bool = False):
+        self.latency = latency
+        self.flat = flat
+
+    def info(self, id: str, title: str):
+        formats = [{'format_id': '251', 'url': 'https://r1.googlevideo.com/{}/251?expire=9999999999'.format(id),
+                    'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none', 'abr': 160},
+                   {'format_id': '140', 'url': 'https://r1.googlevideo.com/{}/140?expire=9999999999'.format(id),
+                    'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none', 'abr': 128}]
+        return {'id': id, 'title': title, 'uploader': 'Someone', 'uploader_url': 'https://www.youtube.com/c/someone',
+                'upload_date': '20200101', 'duration': 215, 'webpage_url': 'https://www.youtube.com/watch?v=' + id,
+                'thumbnail': 'https://i.ytimg.com/vi/{}/hqdefault.jpg'.format(id), 'url': formats[0]['url'],
+                'acodec': 'opus', 'abr': 160, 'formats': formats, 'tags': ['benchmark', title.split()[0]]}
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True):
+        if self.latency:
+            time.sleep(self.latency)
+        if url.startswith('ytsearch'):
+            query = url.split(':', 1)[1]
+            id = '{:011x}'.format(hash(query) & 0xfffffffffff)
+            if self.flat:
+                return {'_type': 'playlist', 'entries': [{'_type': 'url', 'ie_key': 'Youtube', 'id': id, 'url': id,
+                                                          'title': query, 'uploader': 'Someone', 'duration': 215}]}
+            return {'_type': 'playlist', 'entries': [self.info(id, query)]}
+        id = url.rsplit('=', 1)[-1]
+        return self.info(id, 'Track ' + id)
+
+
+class StubAudio(discord.AudioSource):
+    # Stands in for FFmpeg: no process, no frames.
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def read(self):
+        return b''
+
+    def is_opus(self):
+        return True
+
+
+class StubMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.id = random.getrandbits(48)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class StubChannel:
+    def __init__(self, id: int):
+        self.id = id
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+        return StubMessage(self, content, embed)
+
+
+class StubGuild:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class StubVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class StubMember:
+    bot = False
+
+    def __init__(self, id: int, voice_channel):
+        self.id = id
+        self.mention = '<@{}>'.format(id)
+        self.voice = StubVoiceState(voice_channel)
+
+
+class StubVoiceClient:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return True
+
+    def play(self, source, after=None):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class StubContext:
+    # Enough of commands.Context for the cog's commands; replies go through the outbox like PeteContext's do.
+    def __init__(self, guild_id: int, user_id: int, voice_state=None):
+        self.guild = StubGuild(guild_id)
+        self.channel = StubChannel(guild_id)
+        self.author = StubMember(user_id, object())
+        self.message = StubMessage(self.channel)
+        self.voice_state = voice_state
+        self.received = time.perf_counter()
+
+    async def send(self, content=None, *, embed=None):
+        return await DJ_Pete.Outbox.of(self.channel).send(content, embed)
+
+    def typing(self):
+        return Typing()
+
+    async def invoke(self, command, **kwargs):
+        return await command.callback(cog(), self, **kwargs)
+
+
+def cog():
+    return DJ_Pete.bot.get_cog('Music')
+
+
+def install(latency: float):
+    DJ_Pete.YTDLSource.ytdl = FakeYoutubeDL(latency)
+    DJ_Pete.YTDLSource.ytdl_flat = FakeYoutubeDL(latency, flat=True)
+    DJ_Pete.YTDLSource.ytdl_playlist = FakeYoutubeDL(latency, flat=True)
+    DJ_Pete.YTDLSource.extractors_ready.set()
+    DJ_Pete.YTDLSource.OPUS_PASSTHROUGH = True
+    discord.FFmpegOpusAudio = StubAudio
+    discord.FFmpegPCMAudio = StubAudio
+    # The stub channel answers instantly, so Discord's pacing would only measure the bucket's sleep.
+    DJ_Pete.Outbox.BUCKET = 10 ** 9
+    DJ_Pete.Outbox.outboxes.clear()
+    for part in (DJ_Pete.YTDLSource.index, DJ_Pete.YTDLSource.radio):
+        if not part.loaded:
+            part.load()
+            part.finish()
+
+
+def voice_state(guild_id: int, songs: int):
+    state = DJ_Pete.VoiceState(DJ_Pete.bot)
+    state.voice = StubVoiceClient(object())
+    # A player that never finishes keeps start() from spinning up the real one.
+    state.audio_player = asyncio.get_event_loop().create_future()
+    state.lookahead = 0
+    origin = DJ_Pete.Origin(StubMember(1, None), StubChannel(guild_id))
+    for i in range(songs):
+        state.songs.put_nowait(song(origin, i))
+    return state
+
+
+def song(origin, i: int):
+    id = 'id{:09d}'.format(i)
+    return DJ_Pete.Song(origin, {'_type': 'url', 'id': id, 'webpage_url': 'https://www.youtube.com/watch?v=' + id,
+                                 'title': 'Track number {}'.format(i), 'uploader': 'Someone', 'duration': 215})
+
+
+class Runner:
+    def __init__(self, repeat: int, pattern: str):
+        self.repeat = repeat
+        self.pattern = pattern
+        self.results = []
+
+    def wanted(self, name: str):
+        return not self.pattern or self.pattern in name
+
+    async def time(self, name: str, call, number: int, setup=None, **params):
+        # Best and median of `repeat` rounds of `number` calls; `setup` runs before each round, untimed.
+        if not self.wanted(name):
+            return
+        rounds = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                await maybe_await(setup())
+            start = time.perf_counter()
+            for i in range(number):
+                await maybe_await(call(i))
+            rounds.append((time.perf_counter() - start) / number)
+        result = dict(benchmark=name, params=params, calls=number, best_us=min(rounds) * 1e6,
+                      median_us=statistics.median(rounds) * 1e6)
+        self.results.append(result)
+        print('{:<28} {:<24} {:>12.1f} us {:>12.1f} us'.format(
+            name, ' '.join('{}={}'.format(k, v) for k, v in params.items()), result['best_us'], result['median_us']))
+
+
+async def maybe_await(value):
+    if asyncio.iscoroutine(value) or isinstance(value, asyncio.Future):
+        return await value
+    return value
+
+
+async def bench_create_source(runner: Runner, latency: float):
+    ctx = StubContext(10, 1)
+    counter = iter(range(10 ** 9))
+
+    async def cold(i):
+        source = await DJ_Pete.YTDLSource.create_source(ctx, 'cold song {}'.format(next(counter)))
+        source.cleanup()
+
+    async def warm(i):
+        source = await DJ_Pete.YTDLSource.create_source(ctx, 'warm song')
+        source.cleanup()
+
+    await warm(0)
+    await runner.time('create_source.cold', cold, 50, latency_ms=latency * 1000)
+    await runner.time('create_source.warm', warm, 500, latency_ms=latency * 1000)
+
+
+async def bench_song_queue(runner: Runner, sizes):
+    origin = DJ_Pete.Origin(StubMember(1, None), StubChannel(1))
+    for size in sizes:
+        state = voice_state(20, 0)
+        songs = state.songs
+
+        def fill():
+            songs._queue.clear()
+            for i in range(size):
+                songs.put_nowait(song(origin, i))
+
+        fill()
+        spare = song(origin, -1)
+        middle = size // 2
+        rng = random.Random(0)
+
+        def move(i):
+            songs.move(rng.randrange(size), rng.randrange(size))
+
+        def insert_remove(i):
+            songs.insert(middle, spare)
+            songs._queue.pop(middle)
+
+        def page(i):
+            start = rng.randrange(0, size, 10)
+            return songs[start:start + 10]
+
+        await runner.time('queue.put', lambda i: songs.put_nowait(spare), 1000,
+                          setup=fill, size=size)
+        fill()
+        await runner.time('queue.get', lambda i: songs.get_nowait(), min(size, 1000), setup=fill, size=size)
+        fill()
+        await runner.time('queue.index', lambda i: songs[rng.randrange(size)], 1000, size=size)
+        await runner.time('queue.slice_page', page, 1000, size=size)
+        await runner.time('queue.insert_remove', insert_remove, 1000, size=size)
+        await runner.time('queue.move', move, 1000, size=size)
+        await runner.time('queue.shuffle', lambda i: songs.shuffle(), 5 if size >= 100000 else 50, size=size)
+
+
+async def bench_queue_command(runner: Runner, sizes):
+    music = cog()
+    for size in sizes:
+        ctx = StubContext(30, 1, voice_state(30, size))
+        pages = max(1, -(-size // 10))
+        for label, page in (('first', 1), ('middle', (pages + 1) // 2), ('last', pages)):
+            await runner.time('command.queue', lambda i: music._queue.callback(music, ctx, page=page), 200,
+                              size=size, page=label)
+
+
+async def bench_play(runner: Runner):
+    music = cog()
+    for user_id, opinion in ((41, 5), (42, 50), (43, 95)):
+        music.known_users[user_id] = opinion
+        for rule in ('play', 'queued'):
+            ctx = StubContext(40, user_id)
+
+            def react(i, ctx=ctx, rule=rule, opinion=opinion):
+                # Pinned so every call lands on the same tier instead of drifting with the deltas.
+                music.mood = music.known_users[user_id] = opinion
+                return music.react(ctx, rule, music.affinity(user_id), '**Song** by **Someone**')
+
+            await runner.time('ladder.' + rule, react, 2000, opinion=opinion)
+
+    # The whole command with a cached search: ladders, lookup, queueing and both replies.
+    music.known_users[44] = 50
+    state = voice_state(44, 0)
+    ctx = StubContext(44, 44, state)
+
+    def play(i):
+        music.mood = music.known_users[44] = 50
+        return music._play.callback(music, ctx, search='warm song')
+
+    await play(0)
+    await runner.time('command.play', play, 500, setup=lambda: state.songs._queue.clear(), cached=True)
+
+
+async def bench_save_state(runner: Runner, sizes, dirty: int):
+    music = cog()
+    music.saveState.cancel()
+    for size in sizes:
+        # Straight into the store, then read back, so the cog starts from a clean view of `size` users.
+        music.store.write(([(id, 50.0) for id in range(size)], []), ([], []))
+        music.known_users, music.counters, music._seq = music.store.load()
+        rng = random.Random(size)
+
+        def touch():
+            for id in rng.sample(range(size), min(dirty, size)):
+                music.known_users[id] += 1
+
+        await runner.time('save_state', lambda i: music.saveState.coro(music), 1, setup=touch,
+                          users=size, dirty=min(dirty, size))
+        await runner.time('save_state.clean', lambda i: music.saveState.coro(music), 20, users=size)
+
+
+def compare(results: list, path: str, threshold: float):
+    with open(path) as infile:
+        old = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(infile)['results']}
+    print('\ncompared with {}'.format(path))
+    for result in results:
+        before = old.get((result['benchmark'], json.dumps(result['params'], sort_keys=True)))
+        if before is None:
+            continue
+        ratio = result['best_us'] / before['best_us'] if before['best_us'] else float('inf')
+        flag = '  slower' if ratio > 1 + threshold else '  faster' if ratio < 1 - threshold else ''
+        print('{:<28} {:<24} {:>12.1f} -> {:>10.1f} us  {:5.2f}x{}'.format(
+            result['benchmark'], ' '.join('{}={}'.format(k, v) for k, v in result['params'].items()),
+            before['best_us'], result['best_us'], ratio, flag))
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=sandbox.ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    install(args.latency)
+    runner = Runner(args.repeat, args.filter)
+    sizes = [10, 1000] if args.quick else [10, 1000, 100000]
+    print('{:<28} {:<24} {:>15} {:>15}'.format('benchmark', 'params', 'best', 'median'))
+    await bench_create_source(runner, args.latency)
+    await bench_song_queue(runner, sizes)
+    await bench_queue_command(runner, sizes)
+    await bench_play(runner)
+    await bench_save_state(runner, [1000, 100000] if args.quick else [1000, 100000, 1000000], args.dirty)
+    return runner.results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the command and queue hot paths.')
+    parser.add_argument('--output', type=sandbox.path,
+                        help='where to write the JSON results (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', type=sandbox.path, help='an earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change worth flagging in a comparison')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake youtube_dl takes per call')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dirty', type=int, default=100, help='users changed between saves')
+    parser.add_argument('--quick', action='store_true', help='skip the largest sizes')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(main(args))
+
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(sandbox.RESULTS, started.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump({'time': started.isoformat(timespec='seconds'), 'commit': commit(),
+                   'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                   'args': vars(args), 'results': results}, outfile, indent=2)
+    print('\nwrote {}'.format(output))
+    if args.compare:
+        compare(results, args.compare, args.threshold)
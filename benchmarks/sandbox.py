@@ -0,0 +1,25 @@
+import atexit
+import os
+import sys
+import tempfile
+
+# Importing the bot builds the cog, which opens its databases in the working directory. Benchmarks
+# import this first so those land in a throwaway directory that is removed on exit.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+CWD = os.getcwd()
+
+sys.path.insert(0, ROOT)
+_directory = tempfile.TemporaryDirectory(prefix='pete-bench-')
+os.chdir(_directory.name)
+
+
+def path(value: str):
+    # For argparse: paths on the command line mean what they did in the directory the benchmark was started from.
+    return os.path.abspath(os.path.join(CWD, os.path.expanduser(value)))
+
+
+@atexit.register
+def _cleanup():
+    os.chdir(CWD)
+    _directory.cleanup()
@@ -0,0 +1,529 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import http.server
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import threading
+import time
+import types
+import urllib.request
+
+import sandbox  # before DJ_Pete: the import opens databases in the working directory
+import DJ_Pete
+
+discord = DJ_Pete.discord
+
+try:
+    import nacl.secret
+except ImportError:
+    nacl = None
+
+FRAME = 3840
+COMMANDS = (('play', 45), ('queue', 20), ('skip', 20), ('fs', 5), ('feelings', 5), ('shuffle', 5))
+
+
+def wav(seconds: float):
+    # A quiet 440 Hz tone: 48 kHz, 16-bit stereo, the shape Discord wants before Opus.
+    frames = int(seconds * 48000)
+    one = b''.join(struct.pack('<hh', sample, sample) for sample in
+                   (int(3000 * math.sin(2 * math.pi * 440 * i / 48000)) for i in range(480)))
+    pcm = one * (frames // 480)
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(pcm), b'WAVE', b'fmt ', 16, 1, 2, 48000,
+                         48000 * 4, 4, 16, b'data', len(pcm))
+    return header + pcm
+
+
+def serve_media(port, seconds: float):
+    # Runs in its own process so the media threads don't show up in the bot's thread count or GIL.
+    body = wav(seconds)
+
+    class Media(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Media)
+    server.daemon_threads = True
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+class FakeYoutubeDL:
+    # Search and extraction answers pointing at the local media server, after `latency` seconds.
+    def __init__(self, base: str, latency: float, seconds: float, flat: bool = False):
+        self.base = base
+        self.latency = latency
+        self.seconds = seconds
+        self.flat = flat
+
+    def info(self, id: str, title: str):
+        url = '{}/media/{}.wav'.format(self.base, id)
+        return {'id': id, 'title': title, 'uploader': title.split(' - ')[0], 'upload_date': '20200101',
+                'duration': self.seconds, 'webpage_url': 'https://www.youtube.com/watch?v=' + id, 'url': url,
+                'acodec': 'pcm_s16le', 'abr': 1536, 'tags': [title.split(' - ')[0]],
+                'formats': [{'format_id': 'wav', 'url': url, 'ext': 'wav', 'acodec': 'pcm_s16le', 'vcodec': 'none',
+                             'abr': 1536}]}
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True):
+        time.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+        if url.startswith('ytsearch'):
+            query = url.split(':', 1)[1]
+            id = 's{:010x}'.format(hash(query) & 0xffffffffff)
+            if self.flat:
+                return {'_type': 'playlist', 'entries': [{'_type': 'url', 'ie_key': 'Youtube', 'id': id, 'url': id,
+                                                          'title': query, 'duration': self.seconds}]}
+            return {'_type': 'playlist', 'entries': [self.info(id, query)]}
+        id = url.rsplit('=', 1)[-1]
+        return self.info(id, 'Artist {} - Track {}'.format(id[:3], id))
+
+
+class HTTPFrames(discord.AudioSource):
+    # Without FFmpeg: pulls 20 ms of PCM per read straight from the media server and hands on a
+    # frame-sized slice of it as if it were Opus.
+    def __init__(self, location: str, **kwargs):
+        self.location = location
+        self.response = None
+
+    def read(self):
+        if self.response is None:
+            self.response = urllib.request.urlopen(self.location)
+            self.response.read(44)
+        data = self.response.read(FRAME)
+        return data[:160] if len(data) == FRAME else b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.response is not None:
+            self.response.close()
+
+
+class Voice:
+    # Whatever the voice clients have seen, summed across all guilds. Only the player threads write it.
+    frames = 0
+    late = 0
+    lock = threading.Lock()
+
+
+class FakeVoiceClient:
+    # A voice connection that runs discord.py's real AudioPlayer thread but sends packets nowhere.
+    def __init__(self, guild, channel, loop):
+        self.guild = guild
+        self.channel = channel
+        self.loop = loop
+        self.ws = None
+        self._connected = threading.Event()
+        self._connected.set()
+        self._player = None
+        self._last = None
+        self._box = nacl.secret.SecretBox(bytes(32)) if nacl is not None else None
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def play(self, source, *, after=None):
+        if not self.is_connected():
+            raise discord.ClientException('Not connected to voice.')
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self._last = None
+        self._player = discord.player.AudioPlayer(source, self, after=after)
+        self._player.start()
+
+    def send_audio_packet(self, data: bytes, *, encode: bool = True):
+        now = time.perf_counter()
+        if self._box is not None:
+            self._box.encrypt(bytes(12) + data, bytes(24))
+        late = self._last is not None and now - self._last > 0.04
+        self._last = now
+        with Voice.lock:
+            Voice.frames += 1
+            Voice.late += late
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected.clear()
+        self.guild.voice_client = None
+
+
+class FakeHTTP:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    async def call(self, route: str):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_typing(self, channel_id: int):
+        await self.call('typing')
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, state, channel, author, content: str = None, embed=None):
+        self.id = next(self.ids)
+        self._state = state
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.sent = time.perf_counter()
+
+    async def add_reaction(self, emoji):
+        await self._state.http.call('reaction')
+
+    async def edit(self, *, embed=None, **kwargs):
+        await self._state.http.call('edit')
+        self.embed = embed
+
+
+class FakeTextChannel:
+    def __init__(self, state, guild, id: int):
+        self._state = state
+        self.guild = guild
+        self.id = id
+        self.name = 'music'
+        self.mention = '<#{}>'.format(id)
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        await self._state.http.call('send')
+        return FakeMessage(self._state, self, self.guild.me, content, embed)
+
+    def permissions_for(self, member):
+        return discord.Permissions.all() if member.admin else discord.Permissions.text()
+
+
+class FakeVoiceChannel:
+    def __init__(self, state, guild, id: int):
+        self._state = state
+        self.guild = guild
+        self.id = id
+        self.bitrate = 64000
+        self.members = []
+
+    async def connect(self):
+        await self._state.http.call('voice_connect')
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, self._state.loop)
+        return self.guild.voice_client
+
+
+class FakeMember:
+    def __init__(self, guild, id: int, admin: bool = False, bot: bool = False, voice_channel=None):
+        self.guild = guild
+        self.id = id
+        self.admin = admin
+        self.bot = bot
+        self.name = self.display_name = 'user{}'.format(id)
+        self.mention = '<@{}>'.format(id)
+        self.voice = types.SimpleNamespace(channel=voice_channel) if voice_channel else None
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, state, id: int, members: int):
+        self.id = id
+        self.name = 'guild{}'.format(id)
+        self.voice_client = None
+        self.text = FakeTextChannel(state, self, id * 10 + 1)
+        self.voice = FakeVoiceChannel(state, self, id * 10 + 2)
+        self.me = FakeMember(self, 1, bot=True)
+        self.members = [FakeMember(self, id * 100 + i, admin=i == 0, voice_channel=self.voice) for i in range(members)]
+        self.voice.members = list(self.members)
+
+    def get_member(self, id: int):
+        return next((member for member in self.members if member.id == id), None)
+
+    def get_channel(self, id: int):
+        return {self.text.id: self.text, self.voice.id: self.voice}.get(id)
+
+
+class FakeGateway:
+    # Turns simulated users into MESSAGE_CREATE dispatches, the way the real gateway feeds the bot.
+    def __init__(self, bot, guilds: int, members: int, rest_latency: float):
+        self.bot = bot
+        self.http = FakeHTTP(rest_latency)
+        self.state = types.SimpleNamespace(loop=bot.loop, http=self.http)
+        self.guilds = [FakeGuild(self.state, 1000 + i, members) for i in range(guilds)]
+        bot._connection.user = types.SimpleNamespace(id=1, bot=True, name='Pete', mention='<@1>')
+
+    def send(self, guild: FakeGuild, member: FakeMember, content: str):
+        message = FakeMessage(self.state, guild.text, member, content)
+        self.bot.dispatch('message', message)
+        return message
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lag = []
+        self.interval = collections.defaultdict(list)
+        self.interval_lag = []
+
+    async def completed(self, ctx):
+        self.record(ctx)
+
+    def record(self, ctx):
+        latency = time.perf_counter() - ctx.message.sent
+        name = ctx.command.name
+        self.latencies[name].append(latency)
+        self.interval[name].append(latency)
+
+    async def failed(self, ctx, error):
+        self.errors[type(error).__name__] += 1
+        if ctx.command is not None:
+            self.record(ctx)
+
+    def take_interval(self):
+        interval, self.interval = self.interval, collections.defaultdict(list)
+        lag, self.interval_lag = self.interval_lag, []
+        return interval, lag
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {'p{}'.format(p): None for p in points}
+    values = sorted(values)
+    return {'p{}'.format(p): round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2)
+            for p in points}
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child_processes():
+    pid = str(os.getpid())
+    count = 0
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/{}/stat'.format(entry)) as stat:
+                        if stat.read().rsplit(')', 1)[1].split()[1] == pid:
+                            count += 1
+                except (OSError, IndexError):
+                    pass
+    except OSError:
+        return None
+    return count
+
+
+async def watch_loop(recorder: Recorder, period: float = 0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(period)
+        lag = time.perf_counter() - start - period
+        recorder.lag.append(lag)
+        recorder.interval_lag.append(lag)
+
+
+async def user_session(gateway: FakeGateway, guild: FakeGuild, args, titles, weights, ramp: float):
+    rng = random.Random(guild.id ^ args.seed)
+    commands, chances = zip(*COMMANDS)
+    await asyncio.sleep(rng.uniform(0, ramp))
+    gateway.send(guild, guild.members[0], 'Pete, play {}'.format(rng.choices(titles, cum_weights=weights)[0]))
+    while True:
+        await asyncio.sleep(rng.expovariate(args.rate / 60))
+        member = rng.choice(guild.members)
+        command = rng.choices(commands, chances)[0]
+        if command == 'play':
+            gateway.send(guild, member, 'Pete, play {}'.format(rng.choices(titles, cum_weights=weights)[0]))
+        else:
+            gateway.send(guild, member, 'Pete, {}'.format(command))
+
+
+def snapshot(recorder: Recorder, elapsed: float, gateway: FakeGateway, start_rss: float):
+    interval, lag = recorder.take_interval()
+    music = DJ_Pete.bot.get_cog('Music')
+    row = {'elapsed': round(elapsed), 'commands': sum(len(v) for v in interval.values()),
+           'latency_ms': {name: percentiles(values) for name, values in sorted(interval.items())},
+           'loop_lag_ms': dict(percentiles(lag), max=round(max(lag) * 1000, 2) if lag else None),
+           'rss_mb': round(rss_mb(), 1), 'rss_growth_mb': round(rss_mb() - start_rss, 1),
+           'threads': threading.active_count(), 'children': child_processes(),
+           'voice_states': len(music.voice_states), 'frames': Voice.frames, 'late_frames': Voice.late,
+           'rest_calls': dict(gateway.http.calls), 'errors': dict(recorder.errors)}
+    everything = [value for values in interval.values() for value in values]
+    p = percentiles(everything)
+    print('{:>6}s {:>6} cmds  p50 {:>7} p99 {:>7} ms  lag p99 {:>6} max {:>6} ms  rss {:>7.1f} MB (+{:.1f})  '
+          'threads {:>4}  children {:>4}  voice {:>4}  late frames {:.2%}'.format(
+              row['elapsed'], row['commands'], fmt(p['p50']), fmt(p['p99']), fmt(row['loop_lag_ms']['p99']),
+              fmt(row['loop_lag_ms']['max']), row['rss_mb'], row['rss_growth_mb'], row['threads'],
+              row['children'] if row['children'] is not None else '?', row['voice_states'],
+              Voice.late / Voice.frames if Voice.frames else 0))
+    return row
+
+
+def fmt(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+async def soak(args, base: str, ffmpeg: str):
+    bot = DJ_Pete.bot
+    seconds = args.track_seconds
+    DJ_Pete.YTDLSource.ytdl = FakeYoutubeDL(base, args.latency, seconds)
+    DJ_Pete.YTDLSource.ytdl_flat = FakeYoutubeDL(base, args.latency, seconds, flat=True)
+    DJ_Pete.YTDLSource.ytdl_playlist = FakeYoutubeDL(base, args.latency, seconds, flat=True)
+    DJ_Pete.YTDLSource.extractors_ready.set()
+    DJ_Pete.YTDLSource.OPUS_PASSTHROUGH = True
+    if ffmpeg is None:
+        DJ_Pete.AudioCache.ENABLED = False
+        discord.FFmpegOpusAudio = HTTPFrames
+    if args.audio_workers:
+        DJ_Pete.YTDLSource.audio_workers = DJ_Pete.AudioWorkerPool(args.audio_workers,
+                                                                   source_factory=discord.FFmpegOpusAudio)
+        DJ_Pete.YTDLSource.audio_workers.start()
+
+    gateway = FakeGateway(bot, args.guilds, args.members, args.rest_latency)
+    recorder = Recorder()
+    bot.add_listener(recorder.completed, 'on_command_completion')
+    bot.add_listener(recorder.failed, 'on_command_error')
+    music = bot.get_cog('Music')
+    music.start_warm_up()
+
+    # A long tail of songs: a few get asked for all the time, most almost never.
+    titles = ['Artist {} - Song {}'.format(i % 97, i) for i in range(args.songs)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.songs)))
+
+    start_rss = rss_mb()
+    watcher = bot.loop.create_task(watch_loop(recorder))
+    sessions = [bot.loop.create_task(user_session(gateway, guild, args, titles, weights, args.ramp))
+                for guild in gateway.guilds]
+    print('{} guilds x {} members, {} commands/guild/min, ffmpeg: {}, audio workers: {}, PyNaCl: {}'.format(
+        args.guilds, args.members, args.rate, ffmpeg or 'missing (reading PCM straight from the media server)',
+        args.audio_workers or 'off', 'yes' if nacl is not None else 'no'))
+
+    started = time.perf_counter()
+    intervals = []
+    try:
+        while time.perf_counter() - started < args.duration:
+            await asyncio.sleep(min(args.interval, args.duration - (time.perf_counter() - started)))
+            intervals.append(snapshot(recorder, time.perf_counter() - started, gateway, start_rss))
+    finally:
+        for task in sessions + [watcher]:
+            task.cancel()
+        for guild_id in list(music.voice_states):
+            await music.drop_voice_state(guild_id)
+
+    summary = {'latency_ms': {name: dict(percentiles(values), count=len(values))
+                              for name, values in sorted(recorder.latencies.items())},
+               'loop_lag_ms': dict(percentiles(recorder.lag), max=round(max(recorder.lag) * 1000, 2) if recorder.lag else None),
+               'rss_start_mb': round(start_rss, 1), 'rss_end_mb': round(rss_mb(), 1),
+               'rss_peak_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+               'threads_max': max((row['threads'] for row in intervals), default=None),
+               'children_max': max((row['children'] or 0 for row in intervals), default=None),
+               'frames': Voice.frames, 'late_frames': Voice.late, 'errors': dict(recorder.errors),
+               'rest_calls': dict(gateway.http.calls), 'metrics': dict(DJ_Pete.metrics.counters)}
+    print('\ncommand latency (ms)')
+    for name, row in summary['latency_ms'].items():
+        print('  {:<22} n={:<7} p50 {:>8} p95 {:>8} p99 {:>8}'.format(
+            name, row['count'], fmt(row['p50']), fmt(row['p95']), fmt(row['p99'])))
+    lag = summary['loop_lag_ms']
+    print('loop lag (ms): p50 {} p99 {} max {}'.format(fmt(lag['p50']), fmt(lag['p99']), fmt(lag['max'])))
+    print('rss: {} -> {} MB, peak {} MB; threads max {}; child processes max {}'.format(
+        summary['rss_start_mb'], summary['rss_end_mb'], summary['rss_peak_mb'], summary['threads_max'],
+        summary['children_max']))
+    print('frames sent {}, late {}; errors {}'.format(Voice.frames, Voice.late, dict(recorder.errors) or 'none'))
+    return intervals, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the Music cog with hundreds of simulated guilds.')
+    parser.add_argument('--guilds', type=int, default=500)
+    parser.add_argument('--members', type=int, default=4, help='users per guild, all in its voice channel')
+    parser.add_argument('--rate', type=float, default=2, help='commands per guild per minute')
+    parser.add_argument('--duration', type=float, default=3600, help='seconds')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between progress lines')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which every guild sends its first play')
+    parser.add_argument('--latency', type=float, default=0.3, help='mean seconds per fake youtube_dl call')
+    parser.add_argument('--rest-latency', type=float, default=0.05, help='seconds per fake Discord REST call')
+    parser.add_argument('--track-seconds', type=float, default=30)
+    parser.add_argument('--songs', type=int, default=5000, help='distinct songs users ask for')
+    parser.add_argument('--audio-workers', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=sandbox.path,
+                        help='where to write the JSON results (default: benchmarks/results/soak-<time>.json)')
+    args = parser.parse_args()
+
+    port = multiprocessing.Value('i', 0)
+    server = multiprocessing.get_context('fork').Process(target=serve_media, args=(port, args.track_seconds),
+                                                         name='media-server', daemon=True)
+    server.start()
+    while not port.value:
+        time.sleep(0.05)
+    base = 'http://127.0.0.1:{}'.format(port.value)
+
+    try:
+        intervals, summary = DJ_Pete.bot.loop.run_until_complete(soak(args, base, shutil.which('ffmpeg')))
+    finally:
+        server.terminate()
+
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(sandbox.RESULTS, started.strftime('soak-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump({'time': started.isoformat(timespec='seconds'), 'python': platform.python_version(),
+                   'cpus': os.cpu_count(), 'args': vars(args), 'intervals': intervals, 'summary': summary},
+                  outfile, indent=2)
+    print('wrote {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()